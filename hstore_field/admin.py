@@ -0,0 +1,28 @@
+from django.core.urlresolvers import reverse
+from .fields import HStoreField
+from .forms import HstoreDiffField, PaginatedHstoreWidget
+
+
+class HStoreAdminMixin(object):
+    """
+    A ModelAdmin mixin which edits hstore fields with PaginatedHstoreWidget,
+    fetching the pairs of existing instances a page at a time from
+    ``hstore_field.urls``, and saving only the pairs edited.
+    """
+    hstore_page_size = 50
+
+    def formfield_for_dbfield(self, db_field, **kwargs):
+        if isinstance(db_field, HStoreField):
+            kwargs['form_class'] = HstoreDiffField
+            kwargs['widget'] = PaginatedHstoreWidget(page_size=self.hstore_page_size)
+            return db_field.formfield(**kwargs)
+        return super(HStoreAdminMixin, self).formfield_for_dbfield(db_field, **kwargs)
+
+    def get_form(self, request, obj=None, **kwargs):
+        form = super(HStoreAdminMixin, self).get_form(request, obj, **kwargs)
+        if obj is not None:
+            for name, field in form.base_fields.iteritems():
+                if isinstance(field.widget, PaginatedHstoreWidget):
+                    field.widget.url = reverse('hstore_field_page', kwargs={
+                        'app_label': obj._meta.app_label, 'model_name': obj._meta.module_name, 'field': name, 'pk': obj.pk})
+        return form
@@ -0,0 +1,150 @@
+import datetime
+import decimal
+import uuid
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import AutoField
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from .fields import CompactHStoreDictionary
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def _escape_hstore(value):
+    return u'"%s"' % _text(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+
+
+def hstore_text(value):
+    """
+    Serializes a dictionary of strings into the text representation of an
+    hstore, as unicode; byte strings are decoded as UTF-8.
+    """
+    pairs = []
+    for k, v in value.iteritems():
+        pairs.append(u'%s=>%s' % (_escape_hstore(k), u'NULL' if v is None else _escape_hstore(v)))
+    return u', '.join(pairs)
+
+
+def _escape_copy(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_text(value):
+    """
+    Serializes a value prepared for the database into a column of the COPY
+    text format.
+    """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, dict):
+        return _escape_copy(hstore_text(value))
+    elif isinstance(value, (int, long, float, decimal.Decimal)):
+        return str(value)
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, basestring):
+        return _escape_copy(_text(value))
+    else:
+        raise TypeError("%r cannot be copied" % (value,))
+
+
+class CopyStream(object):
+    """
+    A file-like object which reads the lines produced by a generator, so that
+    COPY never holds more than about ``size`` bytes of them in memory.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if size >= 0 and length >= size:
+                break
+        data = ''.join(chunks)
+        if size >= 0:
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = ''
+        return data
+
+
+def copy_insert(model, objs, using=DEFAULT_DB_ALIAS, size=65536):
+    """
+    Inserts the model instances produced by ``objs`` using COPY, streaming
+    them to the database ``size`` bytes at a time. Like ``bulk_create``, this
+    does not call save() or send signals, and does not set the primary key
+    attribute. Returns the number of rows inserted.
+    """
+    if model._meta.parents:
+        raise ValueError("Can't bulk create an inherited model")
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    counter = [0]
+
+    def lines():
+        for obj in objs:
+            values = [copy_text(f.get_db_prep_save(f.pre_save(obj, True), connection=connection)) for f in fields]
+            counter[0] += 1
+            yield (u'\t'.join(values) + u'\n').encode('utf-8')
+
+    sql = 'COPY %s (%s) FROM STDIN' % (qn(model._meta.db_table), ', '.join(qn(f.column) for f in fields))
+    cursor = connection.cursor()
+    cursor.copy_expert(sql, CopyStream(lines()), size)
+    transaction.commit_unless_managed(using=using)
+    return counter[0]
+
+
+def iter_hstore(queryset, field=None, chunk_size=1000):
+    """
+    Iterates over ``queryset`` through a server-side cursor, fetching
+    ``chunk_size`` rows at a time, so that memory use does not grow with the
+    number of rows. If ``field`` is given, yields pairs of each primary key and
+    the HStoreDictionary, or CompactHStoreDictionary if the field is compact,
+    of that hstore field; otherwise, yields model instances, without any
+    extra selects, annotations or related objects.
+    """
+    if isinstance(queryset, EmptyQuerySet):
+        return
+    model = queryset.model
+    if field is not None:
+        model_field = model._meta.get_field(field)
+        wrap = CompactHStoreDictionary if model_field.compact else model_field._attribute_class
+        values = queryset.values_list('pk', field)
+    else:
+        values = queryset.values_list(*[f.name for f in model._meta.fields])
+    connection = connections[queryset.db]
+    try:
+        sql, params = values.query.get_compiler(connection=connection).as_sql()
+    except EmptyResultSet:
+        return
+    connection.cursor()  # connects, and registers hstore, if need be
+    cursor = connection.connection.cursor(name='hstore_field_%s' % uuid.uuid4().hex)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                if field is not None:
+                    yield row[0], wrap(model_field.to_python(row[1]), model_field)
+                else:
+                    obj = model(*row)
+                    obj._state.adding = False
+                    obj._state.db = queryset.db
+                    yield obj
+    finally:
+        cursor.close()
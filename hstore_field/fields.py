@@ -1,44 +1,502 @@
+import copy
 import re
 import os
 import psycopg2
 import subprocess
+import weakref
+import django
+from collections import Mapping
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connections, models, DEFAULT_DB_ALIAS
 from django.db.backends.signals import connection_created
+from django.db.backends.util import truncate_name
+from django.db.models.signals import post_save, post_syncdb
+from psycopg2.extensions import new_type, register_type
 from psycopg2.extras import register_hstore, HstoreAdapter
 from . import forms
+from .query import key_sql, quote_key, sql_safe_casts, HStoreUpdate
+
+
+# The OIDs of the hstore type and its array type, by database alias and
+# DSN, for each database on which hstore has been registered.
+_hstore_oids = {}
+
+
+def clear_hstore_oids(alias=None):
+    """
+    Forgets the cached hstore OIDs of the database ``alias``, or of every
+    database, so that they are discovered again on the next connection.
+    """
+    for key in _hstore_oids.keys():
+        if alias is None or key[0] == alias:
+            del _hstore_oids[key]
+
+
+def hstore_settings(alias):
+    """
+    Returns the hstore configuration of the database ``alias``, from the
+    ``HSTORE_DATABASES`` setting, or None if it does not use hstore. Without
+    the setting, every database uses hstore, with the default configuration:
+    ``ddl``, whether the extension may be created and indexes created by
+    syncdb; ``globally``, whether the hstore type is registered with psycopg2
+    for every connection, rather than for each connection to the database;
+    and ``oids``, the OIDs of the hstore type and its array type, to be used
+    rather than looked up.
+    """
+    databases = getattr(settings, 'HSTORE_DATABASES', None)
+    if databases is None:
+        config = {}
+    elif alias in databases:
+        config = databases[alias]
+    else:
+        return None
+    result = {'ddl': True, 'globally': True, 'oids': getattr(settings, 'HSTORE_OIDS', {}).get(alias)}
+    result.update(config)
+    return result
+
+
+def create_hstore(connection):
+    if connection.connection.server_version < 90000:
+        raise psycopg2.ProgrammingError("Database version not supported")
+    elif connection.connection.server_version < 90100:
+        pg_config = subprocess.Popen(["pg_config", "--sharedir"], stdout=subprocess.PIPE)
+        share_dir = pg_config.communicate()[0].strip('\r\n ')
+        hstore_sql = os.path.join(share_dir, 'contrib', 'hstore.sql')
+        statements = re.compile(r";[ \t]*$", re.M)
+        cursor = connection.cursor()
+        with open(hstore_sql, 'U') as fp:
+            for statement in statements.split(fp.read().decode(settings.FILE_CHARSET)):
+                statement = re.sub(ur"--.*([\n\Z]|$)", "", statement).strip()
+                if statement:
+                    cursor.execute(statement + u";")
+    else:
+        cursor = connection.cursor()
+        cursor.execute("CREATE EXTENSION hstore;")
+
+
+class DatabaseDictionary(dict):
+    """
+    A dictionary read from an hstore column, whose values are all strings or
+    None, so that HStoreField.to_python need not encode them.
+    """
+
+
+def cast_hstore(value, cursor):
+    if value is None:
+        return None
+    return DatabaseDictionary(HstoreAdapter.parse(value, cursor))
 
 
 def register_hstore_on_connection_creation(connection, sender, *args, **kwargs):
-    oid = HstoreAdapter.get_oids(connection.connection)
-    if oid is None or not oid[0]:
-        if connection.connection.server_version < 90000:
-            raise psycopg2.ProgrammingError("Database version not supported")
-        elif connection.connection.server_version < 90100:
-            pg_config = subprocess.Popen(["pg_config", "--sharedir"], stdout=subprocess.PIPE)
-            share_dir = pg_config.communicate()[0].strip('\r\n ')
-            hstore_sql = os.path.join(share_dir, 'contrib', 'hstore.sql')
-            statements = re.compile(r";[ \t]*$", re.M)
-            cursor = connection.cursor()
-            with open(hstore_sql, 'U') as fp:
-                for statement in statements.split(fp.read().decode(settings.FILE_CHARSET)):
-                    statement = re.sub(ur"--.*([\n\Z]|$)", "", statement).strip()
-                    if statement:
-                        cursor.execute(statement + u";")
-        else:
-            cursor = connection.cursor()
-            cursor.execute("CREATE EXTENSION hstore;")
-    register_hstore(connection.connection, globally=True)
+    config = hstore_settings(connection.alias)
+    if config is None:
+        return
+    key = (connection.alias, connection.connection.dsn)
+    oid = _hstore_oids.get(key)
+    if oid is not None and config['globally']:
+        return
+    if oid is None:
+        # Looked up, and the extension created, once per process.
+        oid = config['oids'] or HstoreAdapter.get_oids(connection.connection)
+        if oid is None or not oid[0]:
+            if not config['ddl']:
+                raise ImproperlyConfigured('hstore is not installed in the database %r' % connection.alias)
+            create_hstore(connection)
+            oid = HstoreAdapter.get_oids(connection.connection)
+    register_hstore(connection.connection, globally=config['globally'], oid=oid[0], array_oid=oid[1])
+    oids = tuple(oid[0]) if isinstance(oid[0], (list, tuple)) else (oid[0],)
+    if config['globally']:
+        register_type(new_type(oids, 'HSTORE', cast_hstore))
+    else:
+        register_type(new_type(oids, 'HSTORE', cast_hstore), connection.connection)
+    _hstore_oids[key] = oid
 
 connection_created.connect(register_hstore_on_connection_creation, dispatch_uid='hstore_field.register_hstore_on_connection_creation')
 
 
+def create_indexes(model, using=DEFAULT_DB_ALIAS):
+    """
+    Creates the indexes declared on the hstore fields of ``model``, and the
+    triggers which fill their promoted keys. This is done automatically by
+    syncdb; South migrations should call it after creating the table or
+    adding the field.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    for field in model._meta.local_fields:
+        if isinstance(field, HStoreField):
+            for statement in field.sql_promote(model, connection) + field.sql_indexes(model, connection):
+                cursor.execute(statement)
+
+
+def create_indexes_on_syncdb(sender, created_models, db=DEFAULT_DB_ALIAS, **kwargs):
+    config = hstore_settings(db)
+    if config is None or not config['ddl']:
+        return
+    # Sent once for each application, with the models created for all of them.
+    app_models = models.get_models(sender)
+    for model in created_models:
+        if model in app_models:
+            create_indexes(model, db)
+
+post_syncdb.connect(create_indexes_on_syncdb, dispatch_uid='hstore_field.create_indexes_on_syncdb')
+
+
+def snapshot(value):
+    """
+    Returns a plain copy of the pairs of the hstore dictionary ``value``.
+    """
+    return dict.copy(value)
+
+
+def _unpickle_dictionary(cls, value, model, name):
+    return cls(value, model._meta.get_field(name))
+
+
 class HStoreDictionary(dict):
+    """
+    The value of an hstore field on a model instance. Values are encoded to
+    strings as they are set, and the keys set or deleted since the instance
+    was loaded or last saved are recorded, so that saving an existing
+    instance only writes those keys. A copy of the value as it was loaded is
+    taken before it is first changed, so that a value which has been changed
+    back is not written at all.
+    """
 
     def __init__(self, value=None, field=None, instance=None, **params):
-        super(HStoreDictionary, self).__init__(value, **params)
+        super(HStoreDictionary, self).__init__(value or {}, **params)
         self.field = field
         self.instance = instance
+        self.reset_changes()
+
+    def __reduce__(self):
+        if self.field is None:
+            return (self.__class__, (dict(self),))
+        return (_unpickle_dictionary, (self.__class__, dict(self), self.field.model, self.field.name))
+
+    def reset_changes(self):
+        self.changed_keys = set()
+        self.deleted_keys = set()
+        self.replaced = False
+        self.loaded = None
+
+    def loaded_value(self):
+        if self.loaded is None:
+            return snapshot(self)
+        return self.loaded
+
+    def has_changed(self):
+        return self.loaded is not None and dict.__ne__(self, self.loaded)
+
+    def _touch(self):
+        if self.loaded is None:
+            self.loaded = snapshot(self)
+
+    def __setitem__(self, key, value):
+        self._touch()
+        super(HStoreDictionary, self).__setitem__(key, forms.to_hstore(value))
+        self.changed_keys.add(key)
+        self.deleted_keys.discard(key)
+
+    def __delitem__(self, key):
+        self._touch()
+        super(HStoreDictionary, self).__delitem__(key)
+        self.changed_keys.discard(key)
+        self.deleted_keys.add(key)
+
+    def clear(self):
+        self._touch()
+        super(HStoreDictionary, self).clear()
+        self.replaced = True
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super(HStoreDictionary, self).pop(key, *default)
+
+    def popitem(self):
+        self._touch()
+        key, value = super(HStoreDictionary, self).popitem()
+        self.changed_keys.discard(key)
+        self.deleted_keys.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+
+class TypedHStoreDictionary(HStoreDictionary):
+    """
+    An HStoreDictionary which decodes the values of the keys in its field's
+    schema back into Python types. Values are decoded the first time they
+    are read, and the decoded values are cached; the dictionary itself
+    keeps the strings, which are written back unchanged when it is saved.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TypedHStoreDictionary, self).__init__(*args, **kwargs)
+        self.decoded = {}
+
+    def __getitem__(self, key):
+        try:
+            return self.decoded[key]
+        except KeyError:
+            value = super(TypedHStoreDictionary, self).__getitem__(key)
+            type_ = self.field.schema.get(key) if self.field else None
+            if type_ is not None:
+                value = self.decoded[key] = forms.from_hstore(value, type_)
+            return value
+
+    def __setitem__(self, key, value):
+        super(TypedHStoreDictionary, self).__setitem__(key, value)
+        self.decoded.pop(key, None)
+
+    def __delitem__(self, key):
+        super(TypedHStoreDictionary, self).__delitem__(key)
+        self.decoded.pop(key, None)
+
+    def clear(self):
+        super(TypedHStoreDictionary, self).clear()
+        self.decoded.clear()
+
+    def popitem(self):
+        key, value = super(TypedHStoreDictionary, self).popitem()
+        self.decoded.pop(key, None)
+        return key, value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class UnloadedKeyError(LookupError):
+    pass
+
+
+class PartialHStoreDictionary(HStoreDictionary):
+    """
+    A read-only HStoreDictionary holding only some of the keys of a value,
+    as loaded by ``query.only_keys``. Reading a key which was not loaded
+    raises UnloadedKeyError rather than KeyError, so that it cannot be
+    mistaken for a key missing from the database.
+    """
+
+    def __init__(self, value=None, field=None, instance=None, loaded_keys=(), **params):
+        super(PartialHStoreDictionary, self).__init__(value, field, instance, **params)
+        self.loaded_keys = frozenset(loaded_keys)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), None, None, self.loaded_keys))
+
+    def _check_loaded(self, key):
+        if key not in self.loaded_keys:
+            raise UnloadedKeyError('%r was not loaded' % (key,))
+
+    def __getitem__(self, key):
+        self._check_loaded(key)
+        value = super(PartialHStoreDictionary, self).__getitem__(key)
+        type_ = self.field.schema.get(key) if self.field else None
+        return forms.from_hstore(value, type_) if type_ is not None else value
+
+    def __contains__(self, key):
+        self._check_loaded(key)
+        return super(PartialHStoreDictionary, self).__contains__(key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('a partially loaded hstore dictionary is read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+class KeyLayout(object):
+    """
+    The sorted keys of compact dictionaries which have the same keys, shared
+    between them, and the index of each key.
+    """
+
+    __slots__ = ('keys', 'index', '__weakref__')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((key, i) for i, key in enumerate(keys))
+
+_layouts = weakref.WeakValueDictionary()
+
+
+def key_layout(keys):
+    """
+    Returns the shared KeyLayout of ``keys``.
+    """
+    keys = tuple(sorted(keys))
+    layout = _layouts.get(keys)
+    if layout is None:
+        layout = KeyLayout(tuple(intern(key) if type(key) is str else key for key in keys))
+        _layouts[layout.keys] = layout
+    return layout
+
+
+class CompactHStoreDictionary(object):
+    """
+    A read-mostly mapping holding the value of an hstore field as loaded from
+    the database, in much less memory than an HStoreDictionary: it has no
+    instance dictionary, and stores only a tuple of values, in the order of a
+    KeyLayout shared by every value with the same keys. The first change
+    copies it into an HStoreDictionary of its field, which replaces it on
+    its instance, and to which it delegates from then on.
+    """
+
+    __slots__ = ('layout', '_values', 'field', 'instance', '_dict')
+
+    def __init__(self, value=None, field=None, instance=None):
+        value = value or {}
+        self.layout = key_layout(value)
+        self._values = tuple(value[key] for key in self.layout.keys)
+        self.field = field
+        self.instance = instance
+        self._dict = None
+
+    def __reduce__(self):
+        if self.field is None:
+            return (self.__class__, (self.to_dict(),))
+        return (_unpickle_dictionary, (self.__class__, self.to_dict(), self.field.model, self.field.name))
+
+    def to_dict(self):
+        """
+        Returns a dictionary of the strings of the value.
+        """
+        if self._dict is not None:
+            return dict(self._dict)
+        return dict(zip(self.layout.keys, self._values))
+
+    def loaded_value(self):
+        if self._dict is not None:
+            return self._dict.loaded_value()
+        return dict(zip(self.layout.keys, self._values))
+
+    def has_changed(self):
+        return self._dict is not None and self._dict.has_changed()
+
+    def _materialize(self):
+        if self._dict is None:
+            cls = self.field._attribute_class if self.field is not None else HStoreDictionary
+            self._dict = cls(self.to_dict(), self.field, self.instance)
+            if self.instance is not None and self.instance.__dict__.get(self.field.name) is self:
+                self.instance.__dict__[self.field.name] = self._dict
+            self.layout = self._values = None
+        return self._dict
+
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+        value = self._values[self.layout.index[key]]
+        type_ = self.field.schema.get(key) if self.field else None
+        return forms.from_hstore(value, type_) if type_ is not None else value
+
+    def __len__(self):
+        return len(self._dict if self._dict is not None else self._values)
+
+    def __iter__(self):
+        return iter(self._dict if self._dict is not None else self.layout.keys)
+
+    iterkeys = __iter__
+
+    def __contains__(self, key):
+        return key in (self._dict if self._dict is not None else self.layout.index)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        # Compares the strings, as HStoreDictionary does, so that a value
+        # compares the same before and after its first change.
+        if isinstance(other, CompactHStoreDictionary):
+            other = other.to_dict()
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        elif not isinstance(other, dict):
+            other = dict(other.items())
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __setitem__(self, key, value):
+        self._materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self._materialize()[key]
+
+    def clear(self):
+        self._materialize().clear()
+
+    def pop(self, key, *default):
+        return self._materialize().pop(key, *default)
+
+    def popitem(self):
+        return self._materialize().popitem()
+
+    def setdefault(self, key, default=None):
+        return self._materialize().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._materialize().update(*args, **kwargs)
+
+Mapping.register(CompactHStoreDictionary)
 
 
 class HStoreDescriptor(object):
@@ -53,48 +511,250 @@ class HStoreDescriptor(object):
             raise AttributeError()
 
     def __set__(self, instance, value):
-        if not isinstance(value, HStoreDictionary):
-            value = self.field._attribute_class(value, self.field, instance)
+        replaced = self.field.name in instance.__dict__
+        previous = instance.__dict__.get(self.field.name)
+        if replaced and value is previous:
+            # As done by Model.clean_fields, which must not lose the changes.
+            return
+        if isinstance(value, CompactHStoreDictionary) and (replaced or value.instance is not instance):
+            value = value.to_dict()
+        if not isinstance(value, (HStoreDictionary, CompactHStoreDictionary)):
+            if self.field.compact and not replaced and type(value) is DatabaseDictionary:
+                value = CompactHStoreDictionary(self.field.to_python(value), self.field, instance)
+            else:
+                value = self.field._attribute_class(self.field.to_python(value), self.field, instance)
+        if replaced:
+            value.replaced = True
+            if (value.instance is instance and isinstance(previous, (HStoreDictionary, CompactHStoreDictionary))
+                    and previous.instance is instance):
+                value.loaded = previous.loaded_value()
         instance.__dict__[self.field.name] = value
 
 
+# The cast of the values of a key to each type of field which may shadow it.
+promote_types = {
+    'IntegerField': 'integer',
+    'SmallIntegerField': 'integer',
+    'PositiveIntegerField': 'integer',
+    'PositiveSmallIntegerField': 'integer',
+    'BigIntegerField': 'bigint',
+    'DecimalField': 'numeric',
+    'FloatField': 'double precision',
+    'DateTimeField': 'timestamp',
+    'DateField': 'date',
+    'TimeField': 'time',
+    'CharField': None,
+    'TextField': None,
+}
+
+
 class HStoreField (models.Field):
 
     _attribute_class = HStoreDictionary
     _descriptor_class = HStoreDescriptor
 
-    __metaclass__ = models.SubfieldBase
+    index_types = ('gin', 'gist')
+    key_index_types = (None, 'integer', 'double precision')
+    safe_key_index_types = key_index_types + ('timestamp', 'date', 'time')
+
+    def __init__(self, *args, **kwargs):
+        self.schema = kwargs.pop('schema', None) or {}
+        if self.schema:
+            self._attribute_class = TypedHStoreDictionary
+        self.index = kwargs.pop('index', None)
+        self.key_indexes = kwargs.pop('key_indexes', None) or {}
+        self.safe_casts = kwargs.pop('safe_casts', False)
+        self.compact = kwargs.pop('compact', False)
+        self.promote = kwargs.pop('promote', None) or {}
+        self.shadow_fields = {}
+        self.promoted = {}
+        if self.index not in (None,) + self.index_types:
+            raise ValueError('invalid index type %r' % self.index)
+        for key, cast_type in self.key_indexes.iteritems():
+            # Only casts which HStoreConstraint produces and PostgreSQL
+            # accepts in an index expression; date and time casts are not
+            # immutable, so they can only be indexed through the safe casts.
+            if cast_type not in (self.safe_key_index_types if self.safe_casts else self.key_index_types):
+                raise ValueError('invalid index type %r for key %r' % (cast_type, key))
+        for key, shadow in self.promote.iteritems():
+            if shadow.get_internal_type() not in promote_types:
+                raise ValueError('invalid field %r to promote key %r' % (shadow, key))
+        super(HStoreField, self).__init__(*args, **kwargs)
 
     def formfield(self, **params):
-        params['form_class'] = forms.HstoreField
+        params.setdefault('form_class', forms.HstoreField)
         return super(HStoreField, self).formfield(**params)
 
+    def save_form_data(self, instance, data):
+        if isinstance(data, forms.HStoreDiff):
+            data.apply(getattr(instance, self.attname))
+        else:
+            super(HStoreField, self).save_form_data(instance, data)
+
     def contribute_to_class(self, cls, name):
         super(HStoreField, self).contribute_to_class(cls, name)
         setattr(cls, self.name, self._descriptor_class(self))
+        # Connected for every sender, since post_save is sent with the class
+        # of the instance saved, which may be a subclass or a proxy.
+        post_save.connect(self._reset_changes, weak=False)
+        self.shadow_fields = {}
+        self.promoted = {}
+        for key, shadow in sorted(self.promote.iteritems()):
+            # Each promoted key is copied into a nullable column of its own,
+            # placed after the hstore column.
+            shadow = copy.deepcopy(shadow)
+            shadow.null = shadow.blank = True
+            shadow.editable = False
+            shadow.creation_counter = self.creation_counter
+            cls.add_to_class('%s_%s' % (name, re.sub(r'\W', '_', key)), shadow)
+            self.shadow_fields[key] = shadow
+            self.promoted[key] = (shadow.column, promote_types[shadow.get_internal_type()])
+
+    def _reset_changes(self, instance, update_fields=None, **kwargs):
+        if not isinstance(instance, self.model):
+            return
+        if update_fields is not None and self.name not in update_fields:
+            return
+        value = instance.__dict__.get(self.name)
+        if isinstance(value, HStoreDictionary):
+            value.reset_changes()
 
     def db_type(self, connection=None):
         return 'hstore'
 
     def to_python(self, value):
-        if isinstance(value, dict):
-            for k, v in value.iteritems():
-                value[k] = forms.to_hstore(v)
+        if type(value) is DatabaseDictionary:
+            if None in value.itervalues():
+                for k, v in value.iteritems():
+                    if v is None:
+                        value[k] = ''
+            return value
+        elif isinstance(value, (HStoreDictionary, CompactHStoreDictionary)):
+            return value
+        elif isinstance(value, dict):
+            return forms.encode(value)
         return value or {}
 
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname)
+        existing = not add and not model_instance._state.adding
+        if isinstance(value, CompactHStoreDictionary):
+            # Compact values are replaced on their instance when changed.
+            if existing and value.instance is model_instance:
+                return HStoreUpdate(self)
+            value = value.to_dict()
+        if existing and isinstance(value, HStoreDictionary) and value.instance is model_instance:
+            if not value.has_changed():
+                return HStoreUpdate(self)
+            if not value.replaced:
+                changes = dict((key, dict.__getitem__(value, key)) for key in value.changed_keys)
+                self._promote(model_instance, value, value.changed_keys | value.deleted_keys)
+                return HStoreUpdate(self, changes, value.deleted_keys)
+        self._promote(model_instance, value, self.shadow_fields)
+        return value
+
+    def has_changed(self, instance):
+        """
+        Returns whether the value of this field on ``instance`` may differ
+        from its value in the database.
+        """
+        value = instance.__dict__.get(self.attname)
+        return not (isinstance(value, (HStoreDictionary, CompactHStoreDictionary)) and value.instance is instance
+                    and not value.has_changed())
+
+    def _promote(self, instance, value, keys):
+        # The database is kept in sync by a trigger; this only keeps the
+        # instance in sync with it.
+        for key in keys:
+            shadow = self.shadow_fields.get(key)
+            if shadow is not None:
+                try:
+                    promoted = shadow.to_python(dict.get(value, key) or None)
+                except ValidationError:
+                    promoted = None
+                setattr(instance, shadow.attname, promoted)
+
     def get_prep_value(self, value):
         if not value:
             return {}
+        elif isinstance(value, HStoreDictionary):
+            # values are encoded as they are set
+            return dict(value)
+        elif isinstance(value, CompactHStoreDictionary):
+            return value.to_dict()
         elif isinstance(value, dict):
-            result = {}
-            for k, v in value.iteritems():
-                result[k] = forms.to_hstore(v)
-            return result
+            return forms.encode(value)
         else:
             return value
 
+    def sql_indexes(self, model, connection):
+        qn = connection.ops.quote_name
+        max_length = connection.ops.max_name_length()
+        table = model._meta.db_table
+        column = qn(self.column)
+        statements = sql_safe_casts() if self.safe_casts else []
+        if self.index:
+            name = truncate_name('%s_%s_%s' % (table, self.column, self.index), max_length)
+            statements.append('CREATE INDEX %s ON %s USING %s (%s);' % (qn(name), qn(table), self.index, column))
+        for key, cast_type in sorted(self.key_indexes.iteritems()):
+            statements.append(self.sql_key_index(model, connection, key, cast_type))
+        return statements
+
+    def sql_promote(self, model, connection):
+        """
+        Returns the statements which create the trigger that copies the
+        promoted keys into their shadow columns, and fill them for the rows
+        which already exist.
+        """
+        if not self.promoted:
+            return []
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        name = qn(truncate_name('%s_%s_promote' % (table, self.column), connection.ops.max_name_length()))
+        assignments = ''.join('    NEW.%s := %s;\n' % (qn(column), key_sql(key, cast_type, True) % ('NEW.' + qn(self.column)))
+                              for key, (column, cast_type) in sorted(self.promoted.iteritems()))
+        keys = ', '.join(quote_key(key) for key in sorted(self.promoted))
+        return sql_safe_casts() + [
+            'CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$\nBEGIN\n%s    RETURN NEW;\nEND\n$$ LANGUAGE plpgsql;' % (name, assignments),
+            'DROP TRIGGER IF EXISTS %s ON %s;' % (name, qn(table)),
+            'CREATE TRIGGER %s BEFORE INSERT OR UPDATE ON %s FOR EACH ROW EXECUTE PROCEDURE %s();' % (name, qn(table), name),
+            'UPDATE %s SET %s = %s WHERE %s ?| ARRAY[%s];' % (qn(table), qn(self.column), qn(self.column), qn(self.column), keys),
+        ]
+
+    def sql_key_index(self, model, connection, key, cast_type=None):
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        name = truncate_name('%s_%s_%s' % (table, self.column, re.sub(r'\W', '_', key)), connection.ops.max_name_length())
+        return 'CREATE INDEX %s ON %s ((%s));' % (qn(name), qn(table), key_sql(key, cast_type, self.safe_casts) % qn(self.column))
+
     def south_field_triple(self):
         from south.modelsinspector import introspector
         field_class = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
         args, kwargs = introspector(self)
+        if self.index:
+            kwargs['index'] = repr(self.index)
+        if self.key_indexes:
+            kwargs['key_indexes'] = repr(self.key_indexes)
+        if self.safe_casts:
+            kwargs['safe_casts'] = 'True'
+        if self.compact:
+            kwargs['compact'] = 'True'
         return field_class, args, kwargs
+
+
+class SkipUnchangedHStoreMixin(object):
+    """
+    A model mixin which leaves the hstore fields that have not changed since
+    the instance was loaded or last saved out of the UPDATE when it is saved,
+    so that their values are not rewritten. Requires Django 1.5; saves which
+    give ``update_fields`` are left as they are.
+    """
+
+    def save(self, *args, **kwargs):
+        if (django.VERSION >= (1, 5) and not args and not self._state.adding
+                and not kwargs.get('force_insert') and kwargs.get('update_fields') is None):
+            unchanged = set(f.name for f in self._meta.fields if isinstance(f, HStoreField) and not f.has_changed(self))
+            if unchanged:
+                kwargs['update_fields'] = [f.name for f in self._meta.fields
+                                           if not f.primary_key and f.name not in unchanged and f.attname in self.__dict__]
+        super(SkipUnchangedHStoreMixin, self).save(*args, **kwargs)
@@ -1,31 +1,123 @@
+import collections
 import datetime
+import decimal
 import json
 import numbers
 from django import forms
 from django.forms import widgets
 from django.forms.util import flatatt, ValidationError
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
 from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
 from django.utils.html import conditional_escape
 
 
+def _isoformat(obj):
+    return obj.isoformat()
+
+
+def _encode_none(obj):
+    return ''
+
+
+def _encode_method(obj):
+    return obj.to_hstore()
+
+
+def _identity(obj):
+    return obj
+
+
+def _unserializable(obj):
+    raise TypeError("%r is not hstore serializable" % (obj,))
+
+# Functions which encode values of each type, resolved the first time a value
+# of the type is encoded.
+encoders = {
+    type(None): _encode_none,
+    str: _identity,
+    unicode: _identity,
+    int: str,
+    long: str,
+    float: str,
+    datetime.datetime: _isoformat,
+    datetime.date: _isoformat,
+    datetime.time: _isoformat,
+}
+
+
+def encoder_for(type_):
+    try:
+        return encoders[type_]
+    except KeyError:
+        if issubclass(type_, (datetime.datetime, datetime.date, datetime.time)):
+            encoder = _isoformat
+        elif issubclass(type_, numbers.Number):
+            encoder = str
+        elif issubclass(type_, basestring):
+            encoder = _identity
+        elif hasattr(type_, 'to_hstore'):
+            encoder = _encode_method
+        else:
+            encoder = _unserializable
+        encoders[type_] = encoder
+        return encoder
+
+
 def to_hstore(obj):
-    if obj is None:
-        return ''
-    if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date) or isinstance(obj, datetime.time):
-        return obj.isoformat()
-    elif isinstance(obj, numbers.Number):
-        return str(obj)
-    elif isinstance(obj, basestring):
-        return obj
-    elif hasattr(obj, 'to_hstore'):
-        return obj.to_hstore()
-    else:
-        raise TypeError("%r is not hstore serializable" % (obj,))
+    return encoder_for(type(obj))(obj)
+
+
+def encode(value):
+    """
+    Returns a copy of the dictionary ``value`` with every value encoded by
+    ``to_hstore``, or a list of copies if ``value`` is a list of dictionaries.
+    """
+    if not isinstance(value, dict):
+        return [encode(item) for item in value]
+    result = {}
+    for k, v in value.iteritems():
+        type_ = type(v)
+        if type_ is str or type_ is unicode:
+            result[k] = v
+        else:
+            result[k] = (encoders.get(type_) or encoder_for(type_))(v)
+    return result
+
+
+def _parser(parse):
+    def parser(value):
+        result = parse(value)
+        if result is None:
+            raise ValueError("%r is not a valid %s" % (value, parse.__name__[6:]))
+        return result
+    return parser
+
+
+decoders = {
+    bool: lambda value: value == 'True',
+    decimal.Decimal: decimal.Decimal,
+    datetime.datetime: _parser(parse_datetime),
+    datetime.date: _parser(parse_date),
+    datetime.time: _parser(parse_time),
+}
+
+
+def from_hstore(value, type_):
+    """
+    Converts an hstore string back into an instance of ``type_``, which may
+    be any type that ``to_hstore`` encodes, or any callable which accepts a
+    string. Empty strings, which ``to_hstore`` writes for None, become None.
+    """
+    if value is None or value == '':
+        return None
+    return decoders.get(type_, type_)(value)
 
 
 class HstoreEncoder(json.JSONEncoder):
     def default(self, obj):
+        if isinstance(obj, collections.Mapping):
+            return dict(obj.iteritems())
         return to_hstore(obj)
 
 
@@ -63,3 +155,93 @@ class HstoreField (forms.Field):
         except ValueError:
             raise ValidationError(self.error_messages['invalid'])
         return value
+
+
+class HStoreDiff(object):
+    """
+    The pairs set and the keys deleted in a PaginatedHstoreWidget, which
+    HStoreField.save_form_data merges into the value of the field, rather
+    than replacing it.
+    """
+
+    def __init__(self, changes=None, deletions=None):
+        self.changes = changes or {}
+        self.deletions = list(deletions or [])
+
+    def __nonzero__(self):
+        return bool(self.changes or self.deletions)
+
+    def apply(self, value):
+        for key in self.deletions:
+            value.pop(key, None)
+        value.update(self.changes)
+        return value
+
+
+class PaginatedHstoreWidget(widgets.Widget):
+    """
+    A widget which shows the pairs of an hstore ``page_size`` at a time, and
+    posts back only the pairs edited, as a JSON object of the form
+    ``{"set": {key: value}, "delete": [key]}``. If ``url`` is given, pages
+    are fetched from it, as served by ``hstore_field.views.page``; otherwise
+    every pair is rendered into the page.
+    """
+
+    class Media:
+        js = ('hstore_field/paginated_widget.js',)
+
+    def __init__(self, attrs=None, page_size=50, url=None):
+        super(PaginatedHstoreWidget, self).__init__(attrs)
+        self.page_size = page_size
+        self.url = url
+
+    def render(self, name, value, attrs=None, choices=()):
+        final_attrs = self.build_attrs(attrs, type='hidden', name=name)
+        if isinstance(value, basestring):
+            # Redisplayed after a validation error, with the posted diff.
+            diff, pairs = value, None
+        else:
+            diff = u'{}'
+            pairs = None if self.url else sorted((k, to_hstore(v)) for k, v in (value or {}).iteritems())
+        final_attrs['value'] = diff
+        container_id = u'%s_pages' % final_attrs.get('id', name)
+        return mark_safe(
+            u'<div class="hstore-pages" id="%s" data-url="%s" data-pairs="%s" data-size="%d">'
+            u'<input%s /><table><thead><tr><th>Key</th><th>Value</th><th>Delete</th></tr></thead><tbody></tbody></table>'
+            u'<p><button type="button" class="hstore-prev">&lsaquo;</button> <span class="hstore-range"></span> '
+            u'<button type="button" class="hstore-next">&rsaquo;</button> <button type="button" class="hstore-add">Add</button></p>'
+            u'</div><script type="text/javascript">hstorePages(document.getElementById("%s"));</script>' % (
+                conditional_escape(container_id), conditional_escape(self.url or u''),
+                conditional_escape(json.dumps(pairs)), self.page_size, flatatt(final_attrs), conditional_escape(container_id)))
+
+    def value_from_datadict(self, data, files, name):
+        return data.get(name, u'{}')
+
+    def _has_changed(self, initial, data):
+        try:
+            diff = json.loads(data or u'{}')
+        except ValueError:
+            return True
+        return bool(diff.get('set') or diff.get('delete'))
+
+
+class HstoreDiffField (forms.Field):
+    """
+    A form field for PaginatedHstoreWidget, which cleans the posted JSON into
+    an HStoreDiff.
+    """
+    widget = PaginatedHstoreWidget
+    default_error_messages = {'invalid': u'Enter a valid hstore diff.'}
+
+    def clean(self, value):
+        try:
+            diff = json.loads(value or u'{}')
+            changes = diff.get('set') or {}
+            deletions = diff.get('delete') or []
+        except (ValueError, AttributeError):
+            raise ValidationError(self.error_messages['invalid'])
+        if (not isinstance(changes, dict) or not isinstance(deletions, list)
+                or not all(isinstance(key, basestring) for key in deletions)
+                or not all(value is None or isinstance(value, (basestring, int, long, float)) for value in changes.itervalues())):
+            raise ValidationError(self.error_messages['invalid'])
+        return HStoreDiff(changes, deletions)
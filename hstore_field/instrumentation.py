@@ -0,0 +1,188 @@
+import logging
+import re
+import time
+from collections import deque
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends import util
+from django.db.backends.signals import connection_created
+
+# Functions called with each event. Predicates are only tagged, and events
+# only recorded, while there is at least one sink.
+sinks = []
+
+# Whether to EXPLAIN queries with hstore predicates, by database alias, for
+# each database whose queries are timed.
+_explain = {}
+
+_tag = re.compile(r'/\*hstore:([\w.~,-]*)\*/')
+_seq_scan = re.compile(r'Seq Scan on (\S+)(?: (\S+))?')
+
+
+def add_sink(sink):
+    if sink not in sinks:
+        sinks.append(sink)
+
+
+def remove_sink(sink):
+    if sink in sinks:
+        sinks.remove(sink)
+
+
+def enabled():
+    return bool(sinks)
+
+
+def emit(event):
+    for sink in sinks:
+        sink(event)
+
+
+def _quote(value):
+    # Neither % nor the comment delimiters may appear in the SQL.
+    return re.sub(r'[^\w.-]', lambda match: '~%06x' % ord(match.group(0)), unicode(value or ''))
+
+
+def _unquote(value):
+    return re.sub(r'~([0-9a-f]{6})', lambda match: unichr(int(match.group(1), 16)), value)
+
+
+def tag(alias, column, key, lookup_type, cast_type):
+    """
+    Returns an SQL comment identifying an hstore predicate, to be appended to
+    it, so that the predicate can be recognized in the executed SQL.
+    """
+    return '/*hstore:%s*/' % ','.join(_quote(part) for part in (alias, column, key, lookup_type, cast_type))
+
+
+def predicates(sql):
+    """
+    Returns the tagged hstore predicates in ``sql``, as dictionaries.
+    """
+    result = []
+    for match in _tag.finditer(sql):
+        alias, column, key, lookup_type, cast_type = [_unquote(part) for part in match.group(1).split(',')]
+        result.append({'alias': alias, 'column': column, 'key': key or None, 'lookup_type': lookup_type, 'cast_type': cast_type or None})
+    return result
+
+
+class InstrumentedCursor(util.CursorWrapper):
+    """
+    A cursor which times the execution of SQL containing hstore predicates,
+    and optionally checks whether it is planned with a sequential scan of a
+    table with an hstore predicate.
+    """
+
+    def execute(self, sql, params=()):
+        found = predicates(sql) if enabled() else []
+        if not found:
+            return self.cursor.execute(sql, params)
+        seq_scans = None
+        if _explain.get(self.db.alias) and sql.lstrip().upper().startswith('SELECT'):
+            seq_scans = self.seq_scans(sql, params, found)
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            emit({'event': 'execute', 'sql': sql, 'predicates': found, 'seconds': time.time() - start, 'seq_scans': seq_scans})
+
+    def seq_scans(self, sql, params, found):
+        aliases = set(predicate['alias'] for predicate in found)
+        cursor = self.db.connection.cursor()
+        try:
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        scanned = set()
+        for line in plan:
+            for match in _seq_scan.finditer(line):
+                scanned.update(name.strip('"') for name in match.groups() if name)
+        return sorted(aliases & scanned)
+
+
+def _make_cursor(connection):
+    def make_cursor(cursor):
+        if settings.DEBUG:
+            cursor = util.CursorDebugWrapper(cursor, connection)
+        return InstrumentedCursor(cursor, connection)
+    return make_cursor
+
+
+def _install(connection):
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = _make_cursor(connection)
+
+
+def install_on_connection_creation(connection, sender, *args, **kwargs):
+    if connection.alias in _explain and 'make_debug_cursor' not in connection.__dict__:
+        _install(connection)
+
+connection_created.connect(install_on_connection_creation, dispatch_uid='hstore_field.instrumentation.install_on_connection_creation')
+
+
+def time_queries(using=DEFAULT_DB_ALIAS, explain=False):
+    """
+    Times the execution of queries with hstore predicates on the database
+    ``using``. If ``explain`` is true, each of them is also EXPLAINed first,
+    and the aliases of tables with hstore predicates which are scanned
+    sequentially are reported.
+    """
+    _explain[using] = explain
+    _install(connections[using])
+
+
+def stop_timing_queries(using=DEFAULT_DB_ALIAS):
+    _explain.pop(using, None)
+    connection = connections[using]
+    if 'make_debug_cursor' in connection.__dict__:
+        del connection.make_debug_cursor
+        connection.use_debug_cursor = None
+
+
+class LoggingSink(object):
+    """
+    Logs each event.
+    """
+
+    def __init__(self, logger='hstore_field', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def __call__(self, event):
+        keys = ', '.join('%s %s' % (p['key'] or p['column'], p['lookup_type']) for p in event['predicates'])
+        if event.get('seq_scans'):
+            keys += ' (sequential scan of %s)' % ', '.join(event['seq_scans'])
+        self.logger.log(self.level, 'hstore %s %.6fs: %s', event['event'], event['seconds'], keys)
+
+
+class CounterSink(object):
+    """
+    Sends a counter and a timing, in milliseconds, for each predicate of each
+    event to a statsd-like client, which has ``incr(name)`` and
+    ``timing(name, ms)`` methods.
+    """
+
+    def __init__(self, client, prefix='hstore'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, event):
+        for predicate in event['predicates']:
+            name = '.'.join([self.prefix, event['event'], predicate['column'], predicate['key'] or '_', predicate['lookup_type']])
+            self.client.incr(name)
+            self.client.timing(name, event['seconds'] * 1000)
+            if predicate['alias'] in (event.get('seq_scans') or ()):
+                self.client.incr('.'.join([self.prefix, 'seq_scan', predicate['column'], predicate['key'] or '_']))
+
+
+class RingBufferSink(object):
+    """
+    Keeps the last ``size`` events in memory, in ``events``.
+    """
+
+    def __init__(self, size=1000):
+        self.events = deque(maxlen=size)
+
+    def __call__(self, event):
+        self.events.append(event)
@@ -0,0 +1,48 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+from hstore_field.fields import HStoreField
+from hstore_field.stats import key_stats, recommend_cast
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName> <field>'
+    help = "Prints statistics of the keys of an hstore field, and the expression indexes recommended for its most frequent keys."
+    option_list = BaseCommand.option_list + (
+        make_option('--sample', type='int', default=10000, help='Number of rows to sample.'),
+        make_option('--min-frequency', type='float', default=0.1, dest='min_frequency',
+                    help='Fraction of rows in which a key must appear for an index to be recommended.'),
+        make_option('--database', default=DEFAULT_DB_ALIAS, help='Database to sample.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or '.' not in args[0]:
+            raise CommandError('Usage: %s %s' % (__name__.split('.')[-1], self.args))
+        model = get_model(*args[0].split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+        try:
+            field = model._meta.get_field(args[1])
+        except FieldDoesNotExist:
+            field = None
+        if not isinstance(field, HStoreField):
+            raise CommandError('Not an hstore field: %s.%s' % (args[0], args[1]))
+        connection = connections[options['database']]
+        stats = key_stats(model, args[1], options['sample'], options['database'])
+        self.stdout.write('%-30s %9s %9s %9s %9s %9s %9s\n' % ('key', 'frequency', 'distinct', 'integer', 'float', 'date', 'indexed'))
+        recommended = {}
+        for row in stats:
+            indexed = row['key'] in field.key_indexes
+            self.stdout.write('%-30s %9.3f %9d %9.3f %9.3f %9.3f %9s\n' % (
+                row['key'], row['frequency'], row['distinct'], row['integer'], row['float'], row['date'], 'yes' if indexed else ''))
+            if row['frequency'] >= options['min_frequency'] and not indexed:
+                recommended[row['key']] = recommend_cast(row)
+        if recommended:
+            self.stdout.write('\nRecommended indexes:\n\n')
+            for key, cast_type in sorted(recommended.iteritems()):
+                self.stdout.write('%s\n' % field.sql_key_index(model, connection, key, cast_type))
+            key_indexes = dict(field.key_indexes)
+            key_indexes.update(recommended)
+            self.stdout.write('\nwhich may be declared as key_indexes=%r\n' % key_indexes)
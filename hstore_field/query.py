@@ -1,24 +1,237 @@
+import base64
 import datetime
+import decimal
+import json
 import numbers
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connections, models, DEFAULT_DB_ALIAS
+from django.db.models import Aggregate
 from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.datastructures import SortedDict
 from django.utils import tree
 from django.core.exceptions import FieldError
+from . import forms, instrumentation
 try:
     from django.db.models.sql.constants import LOOKUP_SEP
 except:
     from django.db.models.constants import LOOKUP_SEP
 
 
+# Functions which cast hstore values like CAST, but return NULL for values
+# which cannot be cast instead of raising an error. They are declared
+# immutable, so that they may be used in index expressions; to make that
+# true, the date and time functions only cast values in ISO format, which
+# do not depend on DateStyle, and return NULL for any others, like 'now'.
+safe_cast_functions = {
+    'integer': 'hstore_field_integer',
+    'bigint': 'hstore_field_bigint',
+    'numeric': 'hstore_field_numeric',
+    'double precision': 'hstore_field_double',
+    'timestamp': 'hstore_field_timestamp',
+    'date': 'hstore_field_date',
+    'time': 'hstore_field_time',
+}
+
+# Numbers are checked against a pattern, in SQL functions which the planner
+# inlines. The patterns only match values which are in range of the type;
+# other values which look like numbers are cast by the slower function which
+# catches the error, under the name suffixed with _checked.
+_safe_number_sql = """CREATE OR REPLACE FUNCTION %s(text) RETURNS %s AS $$
+    SELECT CASE WHEN $1 ~ '%s' THEN CAST($1 AS %s) WHEN $1 ~* '[0-9]|nan|inf' THEN %s_checked($1) END
+$$ LANGUAGE sql IMMUTABLE;"""
+
+_safe_cast_sql = """CREATE OR REPLACE FUNCTION %s(value text) RETURNS %s AS $$
+BEGIN
+    IF value !~* '%s' THEN
+        RETURN NULL;
+    END IF;
+    RETURN CAST(value AS %s);
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql IMMUTABLE;"""
+
+_safe_number_patterns = {
+    'integer': '^[+-]?[0-9]{1,9}$',
+    'bigint': '^[+-]?[0-9]{1,18}$',
+    'numeric': '^[+-]?([0-9]+([.][0-9]*)?|[.][0-9]+)([eE][+-]?[0-9]{1,3})?$',
+    'double precision': '^[+-]?([0-9]{1,20}([.][0-9]*)?|[.][0-9]+)([eE][+-]?[0-9]{1,2})?$',
+}
+
+_iso_date = '[0-9]{4}-[0-9]{2}-[0-9]{2}'
+_iso_time = '[0-9]{2}:[0-9]{2}(:[0-9]{2}([.][0-9]+)?)?'
+_safe_cast_patterns = {
+    'timestamp': '^[[:space:]]*%s([ t]%s([+-][0-9]{2}(:?[0-9]{2})?|z)?)?[[:space:]]*$' % (_iso_date, _iso_time),
+    'date': '^[[:space:]]*%s[[:space:]]*$' % _iso_date,
+    'time': '^[[:space:]]*%s[[:space:]]*$' % _iso_time,
+}
+
+
+def sql_safe_casts():
+    """
+    Returns the statements which create the safe cast functions.
+    """
+    statements = []
+    for cast_type, function in sorted(safe_cast_functions.iteritems()):
+        if cast_type in _safe_number_patterns:
+            statements.append(_safe_cast_sql % (function + '_checked', cast_type, '[0-9]|nan|inf', cast_type))
+            statements.append(_safe_number_sql % (function, cast_type, _safe_number_patterns[cast_type], cast_type, function))
+        else:
+            statements.append(_safe_cast_sql % (function, cast_type, _safe_cast_patterns[cast_type], cast_type))
+    return statements
+
+
+def cast_sql(sql, cast_type=None, safe=False):
+    """
+    Returns the SQL expression which casts the hstore value ``sql`` to
+    ``cast_type``, treating empty strings as NULL. If ``safe`` is true,
+    values which cannot be cast are also treated as NULL.
+    """
+    if not cast_type:
+        return sql
+    elif safe:
+        try:
+            return '%s(%s)' % (safe_cast_functions[cast_type], sql)
+        except KeyError:
+            raise ValueError('no safe cast to %r' % cast_type)
+    else:
+        return "CAST(NULLIF(%s,'') AS %s)" % (sql, cast_type)
+
+
+def quote_key(key):
+    """
+    Returns ``key`` as an SQL string literal. Percent signs are escaped in
+    the literal, so that it may be used in statements whether or not they
+    are formatted with parameters.
+    """
+    escaped = key.replace('\\', '\\\\').replace("'", "''").replace('%', '\\x25')
+    if escaped != key.replace("'", "''"):
+        return "E'%s'" % escaped
+    return "'%s'" % escaped
+
+
+def key_sql(key, cast_type=None, safe=False):
+    """
+    Returns the SQL expression for ``key`` of an hstore column, with a ``%s``
+    placeholder standing in for the column. Expression indexes must be built
+    from the same expression, or the planner will not use them.
+    """
+    return cast_sql("%%s->%s" % quote_key(key), cast_type, safe)
+
+
+number_types = ('integer', 'bigint', 'numeric', 'double precision')
+
+
+def can_promote(cast_type, shadow_type):
+    """
+    Returns whether values cast to ``cast_type`` may be read from a shadow
+    column of ``shadow_type`` instead.
+    """
+    return cast_type == shadow_type or (cast_type in number_types and shadow_type in number_types)
+
+
+def cast_type_for(value):
+    """
+    Returns the SQL type to which hstore values are cast for comparison
+    with ``value``, or None if they are compared as strings.
+    """
+    if isinstance(value, datetime.datetime):
+        return 'timestamp'
+    elif isinstance(value, datetime.date):
+        return 'date'
+    elif isinstance(value, datetime.time):
+        return 'time'
+    elif isinstance(value, int):
+        return 'integer'
+    elif isinstance(value, numbers.Number):
+        return 'double precision'
+    elif isinstance(value, basestring):
+        return None
+    else:
+        raise ValueError('invalid value %r' % value)
+
+
+cast_types = {
+    int: 'integer',
+    long: 'bigint',
+    float: 'double precision',
+    decimal.Decimal: 'numeric',
+    datetime.datetime: 'timestamp',
+    datetime.date: 'date',
+    datetime.time: 'time',
+    str: None,
+    unicode: None,
+}
+
+
+def resolve_cast(cast):
+    """
+    Returns the SQL type for ``cast``, which may be a Python type, an SQL type
+    name, or None for no cast.
+    """
+    if cast is None or isinstance(cast, basestring):
+        return cast
+    try:
+        return cast_types[cast]
+    except KeyError:
+        raise ValueError('invalid cast %r' % (cast,))
+
+
+class HStoreUpdate(object):
+    """
+    An update expression which changes keys of an hstore column in place,
+    leaving any other keys as they are in the database.
+    """
+
+    def __init__(self, field, changes=None, deletions=None, increments=None):
+        self.field = field
+        self.changes = changes or {}
+        self.deletions = list(deletions or [])
+        self.increments = increments or {}
+
+    def prepare_database_save(self, unused):
+        return self
+
+    def as_sql(self, qn, connection):
+        column = qn(self.field.column)
+        sql = column
+        params = []
+        if self.field.null and (self.changes or self.increments or self.deletions):
+            sql = "COALESCE(%s, ''::hstore)" % sql
+        if self.changes:
+            sql = '(%s || %%s)' % sql
+            params.append(self.changes)
+        for key, amount in sorted(self.increments.iteritems()):
+            lvalue = key_sql(key, cast_type_for(amount), self.field.safe_casts) % column
+            sql = '(%s || hstore(%%s, CAST(COALESCE(%s, 0) + %%s AS text)))' % (sql, lvalue)
+            params.extend([key, amount])
+        if self.deletions:
+            sql = '(%s - %%s::text[])' % sql
+            params.append(self.deletions)
+        return sql, params
+
+
 class HStoreConstraint():
 
     value_operators = {'exact': '=', 'iexact': '=', 'in': 'IN', 'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>='}
 
-    def __init__(self, alias, field, value, lookup_type, key=None):
+    def __init__(self, alias, field, value, lookup_type, key=None, safe=False, promoted=None):
 
         self.lvalue = '%s'
         self.alias = alias
         self.field = field
+        self.column = field
         self.values = [value]
+        self.lookup_type = lookup_type
+        self.key = key
+        self.cast_type = None
 
         if lookup_type == 'contains':
             if isinstance(value, basestring):
@@ -26,8 +239,18 @@ class HStoreConstraint():
             elif isinstance(value, (list, tuple)):
                 self.operator = '?&'
                 self.values = [list(value)]
+            elif isinstance(value, dict):
+                self.operator = '@>'
+                self.values = [forms.encode(value)]
             else:
                 raise ValueError('invalid value %r' % value)
+        elif lookup_type == 'any':
+            if isinstance(value, basestring):
+                value = [value]
+            if not isinstance(value, (list, tuple)):
+                raise ValueError('invalid value %r' % value)
+            self.operator = '?|'
+            self.values = [list(value)]
         elif lookup_type in self.value_operators:
             self.operator = self.value_operators[lookup_type]
             if self.operator == 'IN':
@@ -35,51 +258,81 @@ class HStoreConstraint():
                 self.values = [tuple(value)]
             else:
                 test_value = value
-            if isinstance(test_value, datetime.datetime):
-                cast_type = 'timestamp'
-            elif isinstance(test_value, datetime.date):
-                cast_type = 'date'
-            elif isinstance(test_value, datetime.time):
-                cast_type = 'time'
-            elif isinstance(test_value, int):
-                cast_type = 'integer'
-            elif isinstance(test_value, numbers.Number):
-                cast_type = 'double precision'
-            elif isinstance(test_value, basestring):
-                cast_type = None
-            else:
-                raise ValueError('invalid value %r' % test_value)
-            if cast_type:
-                self.lvalue = "CAST(NULLIF(%%s->'%s','') AS %s)" % (key, cast_type)
+            cast_type = self.cast_type = cast_type_for(test_value)
+            if promoted is not None and lookup_type != 'iexact' and (value or lookup_type != 'in') and can_promote(cast_type, promoted[1]):
+                # Compared with the typed shadow column of the key instead.
+                self.column = promoted[0]
+            elif cast_type:
+                self.lvalue = key_sql(key, cast_type, safe)
             elif lookup_type == 'iexact':
-                self.lvalue = "lower(%%s->'%s')" % key
+                self.lvalue = "lower(%%s->%s)" % quote_key(key)
                 self.values = [value.lower()]
             elif lookup_type == 'in' and not value:
                 self.operator = '?'
                 self.values = [key]
             else:
-                self.lvalue = "%%s->'%s'" % key
+                self.lvalue = key_sql(key)
         else:
             raise TypeError('invalid lookup type')
 
     def sql_for_column(self, qn, connection):
         if self.alias:
-            return '%s.%s' % (qn(self.alias), qn(self.field))
+            return '%s.%s' % (qn(self.alias), qn(self.column))
         else:
-            return qn(self.field)
+            return qn(self.column)
 
     def as_sql(self, qn=None, connection=None):
         lvalue = self.lvalue % self.sql_for_column(qn, connection)
         expr = '%s %s %%s' % (lvalue, self.operator)
+        if instrumentation.enabled():
+            expr += ' ' + instrumentation.tag(self.alias, self.field, self.key, self.lookup_type, self.cast_type)
         return (expr, self.values)
 
 
+class LookupCache(object):
+    """
+    A bounded, least recently used cache of parsed HQ keywords, by HQ class,
+    model and keyword, with counters of hits and misses.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, cache_key, parse, *args):
+        with self.lock:
+            try:
+                result = self.entries.pop(cache_key)
+            except KeyError:
+                pass
+            else:
+                self.entries[cache_key] = result
+                self.hits += 1
+                return result
+        result = parse(*args)
+        with self.lock:
+            self.misses += 1
+            self.entries[cache_key] = result
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return result
+
+lookup_cache = LookupCache(getattr(settings, 'HSTORE_LOOKUP_CACHE_SIZE', 1024))
+
+
 class HQ(tree.Node):
 
     AND = 'AND'
     OR = 'OR'
     default = AND
-    query_terms = ['exact', 'iexact', 'lt', 'lte', 'gt', 'gte', 'in', 'contains']
+    query_terms = ['exact', 'iexact', 'lt', 'lte', 'gt', 'gte', 'in', 'contains', 'any']
 
     def __init__(self, **kwargs):
         super(HQ, self).__init__(children=kwargs.items())
@@ -105,9 +358,70 @@ class HQ(tree.Node):
         return obj
 
     def add_to_query(self, query, used_aliases):
-        self.add_to_node(query.where, query, used_aliases)
+        # Built in a node of its own, so that negating it cannot negate the
+        # rest of the query.
+        start = time.time()
+        node = query.where_class()
+        self.add_to_node(node, query, used_aliases)
+        query.where.add(node, self.AND)
+        if instrumentation.enabled():
+            predicates = [{'alias': c.alias, 'column': c.field, 'key': c.key, 'lookup_type': c.lookup_type, 'cast_type': c.cast_type} for c in _constraints(node)]
+            instrumentation.emit({'event': 'compile', 'predicates': predicates, 'seconds': time.time() - start})
+
+    def parse_lookup(self, model, field):
+        """
+        Parses the keyword ``field`` of a query on ``model``. Returns the path
+        to the hstore field, the lookup type, the key, and the column of the
+        hstore field if it is a local field of ``model``, so that no joins are
+        needed, and the hstore field itself, or None for both otherwise.
+        """
+        parts = field.split(LOOKUP_SEP)
+        if not parts:
+            raise FieldError("Cannot parse keyword query %r" % field)
+        lookup_type = self.query_terms[0]  # Default lookup type
+        num_parts = len(parts)
+        if len(parts) > 1 and parts[-1] in self.query_terms:
+            # Traverse the lookup query to distinguish related fields from
+            # lookup types.
+            lookup_model = model
+            for counter, field_name in enumerate(parts):
+                try:
+                    lookup_field = lookup_model._meta.get_field(field_name)
+                except FieldDoesNotExist:
+                    # Not a field. Bail out.
+                    lookup_type = parts.pop()
+                    break
+                # Unless we're at the end of the list of lookups, let's attempt
+                # to continue traversing relations.
+                if (counter + 1) < num_parts:
+                    try:
+                        lookup_model = lookup_field.rel.to
+                    except AttributeError:
+                        # Not a related field. Bail out.
+                        lookup_type = parts.pop()
+                        break
+        if lookup_type in ('contains', 'any'):
+            key = None
+        else:
+            key = parts[-1]
+            parts = parts[:-1]
+        col = hstore_field = None
+        if len(parts) == 1:
+            try:
+                field, field_model, direct, m2m = model._meta.get_field_by_name(parts[0])
+            except FieldDoesNotExist:
+                pass
+            else:
+                if field_model is None and direct and not m2m:
+                    col, hstore_field = field.column, field
+        return tuple(parts), lookup_type, key, col, hstore_field
 
     def add_to_node(self, where_node, query, used_aliases):
+        # Exact string matches on the same column, joined by AND, are merged
+        # into a single containment test, which a GIN or GiST index can
+        # serve, unless the column has no such index and the key has an
+        # expression index, which the test could not use.
+        pairs = SortedDict()
         for child in self.children:
             if  isinstance(child, HQ):
                 node = query.where_class()
@@ -115,48 +429,419 @@ class HQ(tree.Node):
                 where_node.add(node, self.connector)
             else:
                 field, value = child
-                parts = field.split(LOOKUP_SEP)
-                if not parts:
-                    raise FieldError("Cannot parse keyword query %r" % field)
-                lookup_type = self.query_terms[0]  # Default lookup type
-                num_parts = len(parts)
-                if len(parts) > 1 and parts[-1] in self.query_terms:
-                    # Traverse the lookup query to distinguish related fields from
-                    # lookup types.
-                    lookup_model = query.model
-                    for counter, field_name in enumerate(parts):
-                        try:
-                            lookup_field = lookup_model._meta.get_field(field_name)
-                        except FieldDoesNotExist:
-                            # Not a field. Bail out.
-                            lookup_type = parts.pop()
-                            break
-                        # Unless we're at the end of the list of lookups, let's attempt
-                        # to continue traversing relations.
-                        if (counter + 1) < num_parts:
-                            try:
-                                lookup_model = lookup_field.rel.to
-                            except AttributeError:
-                                # Not a related field. Bail out.
-                                lookup_type = parts.pop()
-                                break
-                if lookup_type == 'contains':
-                    key = None
-                else:
-                    key = parts[-1]
-                    parts = parts[:-1]
-                opts = query.get_meta()
+                parts, lookup_type, key, col, hstore_field = lookup_cache.get((self.__class__, query.model, field), self.parse_lookup, query.model, field)
                 alias = query.get_initial_alias()
-                field, target, opts, join_list, last, extra = query.setup_joins(parts, opts, alias, True)
-                col, alias, join_list = query.trim_joins(target, join_list, last, False, False)
-                where_node.add(HStoreConstraint(alias, col, value, lookup_type, key), self.connector)
+                if col is None:
+                    opts = query.get_meta()
+                    field, target, opts, join_list, last, extra = query.setup_joins(list(parts), opts, alias, True)
+                    col, alias, join_list = query.trim_joins(target, join_list, last, False, False)
+                    hstore_field = field
+                safe = getattr(hstore_field, 'safe_casts', False)
+                promoted = getattr(hstore_field, 'promoted', {}).get(key)
+                mergeable = getattr(hstore_field, 'index', None) in ('gin', 'gist') or key not in getattr(hstore_field, 'key_indexes', {})
+                if self.connector == self.AND and lookup_type == 'exact' and isinstance(value, basestring) and promoted is None and mergeable:
+                    pairs.setdefault((alias, col), {})[key] = value
+                else:
+                    where_node.add(HStoreConstraint(alias, col, value, lookup_type, key, safe, promoted), self.connector)
+        for (alias, col), values in pairs.iteritems():
+            if len(values) > 1:
+                where_node.add(HStoreConstraint(alias, col, values, 'contains'), self.connector)
+            else:
+                key, value = values.items()[0]
+                where_node.add(HStoreConstraint(alias, col, value, 'exact', key), self.connector)
         if self.negated:
             where_node.negate()
 
 
+def _constraints(node):
+    for child in node.children:
+        if isinstance(child, HStoreConstraint):
+            yield child
+        elif isinstance(child, tree.Node):
+            for constraint in _constraints(child):
+                yield constraint
+
+
 def add_hstore(queryset, field, key, name=None):
+    return add_hstore_keys(queryset, field, {name or key: key})
+
+
+def add_hstore_keys(queryset, field, keys):
+    """
+    Adds the values of several keys of the hstore ``field`` to ``queryset`` as
+    extra selects. ``keys`` maps each name to a key, or to a pair of a key and
+    the type to cast its values to, given as for ``resolve_cast``. The names
+    may be used in ``order_by``.
+    """
     assert queryset.query.can_filter(), "Cannot change a query once a slice has been taken"
-    name = name or key
     clone = queryset._clone()
-    clone.query.add_extra({name: "%s -> '%s'" % (field, key)}, None, None, None, None, None)
+    qn = connections[clone.db].ops.quote_name
+    model_field = queryset.model._meta.get_field(field)
+    table = qn(model_field.model._meta.db_table)
+    column = '%s.%s' % (table, qn(model_field.column))
+    select = SortedDict()
+    params = []
+    for name, key in keys.iteritems():
+        cast_type = None
+        if isinstance(key, (list, tuple)):
+            key, cast_type = key[0], resolve_cast(key[1])
+        promoted = model_field.promoted.get(key)
+        if cast_type and promoted is not None and can_promote(cast_type, promoted[1]):
+            select[name] = 'CAST(%s.%s AS %s)' % (table, qn(promoted[0]), cast_type)
+            continue
+        select[name] = cast_sql('%s->%%s' % column, cast_type, model_field.safe_casts)
+        params.append(key)
+    clone.query.add_extra(select, params, None, None, None, None)
+    return clone
+
+
+class HStoreColumn(object):
+
+    def __init__(self, col, key, cast_type=None, safe=False):
+        self.col = col
+        self.key = key
+        self.cast_type = cast_type
+        self.safe = safe
+
+    def as_sql(self, qn, connection):
+        if isinstance(self.col, (list, tuple)):
+            column = '.'.join([qn(c) for c in self.col])
+        else:
+            column = qn(self.col)
+        return key_sql(self.key, self.cast_type, self.safe) % column
+
+
+# The fields whose values aggregates of keys cast to each type are
+# converted as, by the database backend.
+aggregate_sources = {
+    'integer': models.IntegerField(),
+    'bigint': models.BigIntegerField(),
+    'numeric': models.DecimalField(),
+    'double precision': models.FloatField(),
+    'timestamp': models.DateTimeField(),
+    'date': models.DateField(),
+    'time': models.TimeField(),
+    None: models.TextField(),
+}
+
+
+class HStoreAggregate(Aggregate):
+    """
+    An aggregate over the values of ``key`` of the hstore field ``lookup``,
+    cast as for ``resolve_cast``.
+    """
+
+    def __init__(self, lookup, key, cast=None, **extra):
+        super(HStoreAggregate, self).__init__(lookup, **extra)
+        self.key = key
+        self.cast_type = resolve_cast(cast)
+
+    def _default_alias(self):
+        return '%s__%s__%s' % (self.lookup, self.key, self.name.lower())
+    default_alias = property(_default_alias)
+
+    def add_to_query(self, query, alias, col, source, is_summary):
+        klass = getattr(query.aggregates_module, self.name)
+        promoted = getattr(source, 'promoted', {}).get(self.key)
+        if self.cast_type and promoted is not None and isinstance(col, (list, tuple)) and can_promote(self.cast_type, promoted[1]):
+            # Aggregated over the typed shadow column of the key instead.
+            column = (col[0], promoted[0])
+        else:
+            column = HStoreColumn(col, self.key, self.cast_type, getattr(source, 'safe_casts', False))
+        query.aggregates[alias] = klass(column, source=aggregate_sources[self.cast_type], is_summary=is_summary, **self.extra)
+
+
+class HAvg(HStoreAggregate):
+    name = 'Avg'
+
+
+class HCount(HStoreAggregate):
+    name = 'Count'
+
+
+class HMax(HStoreAggregate):
+    name = 'Max'
+
+
+class HMin(HStoreAggregate):
+    name = 'Min'
+
+
+class HSum(HStoreAggregate):
+    name = 'Sum'
+
+
+def _update_hstore(queryset, field, **params):
+    model_field = queryset.model._meta.get_field(field)
+    return queryset.update(**{field: HStoreUpdate(model_field, **params)})
+
+
+def set_keys(queryset, field, values):
+    """
+    Sets the keys in ``values`` on every row of ``queryset`` with a single
+    UPDATE, and returns the number of rows updated.
+    """
+    return _update_hstore(queryset, field, changes=forms.encode(values))
+
+
+def delete_keys(queryset, field, keys):
+    """
+    Deletes ``keys`` from every row of ``queryset`` with a single UPDATE,
+    and returns the number of rows updated.
+    """
+    if isinstance(keys, basestring):
+        keys = [keys]
+    return _update_hstore(queryset, field, deletions=keys)
+
+
+def increment_key(queryset, field, key, amount=1):
+    """
+    Adds ``amount`` to the numeric value of ``key`` on every row of
+    ``queryset`` with a single UPDATE, treating missing or empty values as
+    zero, and returns the number of rows updated.
+    """
+    if not isinstance(amount, numbers.Number):
+        raise ValueError('invalid amount %r' % amount)
+    return _update_hstore(queryset, field, increments={key: amount})
+
+
+class PartialQuerySetMixin(object):
+    """
+    Marks the hstore values loaded by ``only_keys`` as partial. Mixed into
+    the class of the queryset passed to ``only_keys``, so that it keeps
+    working with any QuerySet subclass.
+    """
+
+    hstore_slices = {}
+
+    def _clone(self, *args, **kwargs):
+        clone = super(PartialQuerySetMixin, self)._clone(*args, **kwargs)
+        clone.hstore_slices = self.hstore_slices
+        return clone
+
+    def iterator(self):
+        from .fields import PartialHStoreDictionary
+        for obj in super(PartialQuerySetMixin, self).iterator():
+            for name, keys in self.hstore_slices.iteritems():
+                field = obj._meta.get_field(name)
+                value = field.to_python(obj.__dict__.get(field.attname))
+                obj.__dict__[field.attname] = PartialHStoreDictionary(value, field, obj, keys)
+            yield obj
+
+_partial_classes = {}
+
+
+def only_keys(queryset, field, keys):
+    """
+    Returns a clone of ``queryset`` which loads only ``keys`` of the hstore
+    ``field``, rather than the whole value. The field of each instance is a
+    read-only PartialHStoreDictionary.
+    """
+    assert queryset.query.can_filter(), "Cannot change a query once a slice has been taken"
+    model_field = queryset.model._meta.get_field(field)
+    klass = queryset.__class__
+    if not issubclass(klass, PartialQuerySetMixin):
+        if klass not in _partial_classes:
+            _partial_classes[klass] = type('Partial%s' % klass.__name__, (PartialQuerySetMixin, klass), {})
+        klass = _partial_classes[klass]
+    clone = queryset._clone(klass=klass).defer(field)
+    clone.hstore_slices = dict(clone.hstore_slices, **{field: list(keys)})
+    connection = connections[clone.db]
+    column = '%s.%s' % (connection.ops.quote_name(model_field.model._meta.db_table), connection.ops.quote_name(model_field.column))
+    clone.query.add_extra({model_field.attname: 'slice(%s, %%s)' % column}, [list(keys)], None, None, None, None)
     return clone
+
+
+def hstore_page(model, field, pk, offset=0, limit=100, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the number of keys of the hstore ``field`` of the instance of
+    ``model`` with primary key ``pk``, and a list of ``limit`` of its pairs,
+    in order of key, starting at ``offset``. Only those pairs are read from
+    the database. Returns None if there is no such instance.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    model_field = model._meta.get_field(field)
+    column = qn(model_field.column)
+    opts = model_field.model._meta
+    cursor = connection.cursor()
+    cursor.execute('SELECT array_length(akeys(%s), 1), slice(%s, ARRAY(SELECT k FROM skeys(%s) k ORDER BY k OFFSET %%s LIMIT %%s)) '
+                   'FROM %s WHERE %s = %%s' % (column, column, column, qn(opts.db_table), qn(opts.pk.column)),
+                   [offset, limit, pk])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0] or 0, sorted((row[1] or {}).iteritems())
+
+
+def _grouped_counts(queryset, field, select, select_params, where, where_params, limit, min_count):
+    if isinstance(queryset, EmptyQuerySet):
+        return []
+    try:
+        sql, inner_params = queryset.order_by().values_list(field).query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return []
+    sql = 'SELECT %s, count(*) FROM (%s) s(h)%s GROUP BY 1 HAVING count(*) >= %%s ORDER BY 2 DESC, 1' % (select, sql, where)
+    params = select_params + list(inner_params) + where_params + [min_count]
+    if limit is not None:
+        sql += ' LIMIT %s'
+        params.append(limit)
+    cursor = connections[queryset.db].cursor()
+    cursor.execute(sql, params)
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def key_counts(queryset, field, limit=None, min_count=1):
+    """
+    Returns the keys of the hstore ``field`` in the rows of ``queryset``,
+    with the number of rows which have each, as a list of pairs, most
+    frequent first. Only keys found in at least ``min_count`` rows are
+    returned, and at most ``limit`` of them.
+    """
+    return _grouped_counts(queryset, field, 'skeys(h)', [], '', [], limit, min_count)
+
+
+def value_counts(queryset, field, key, limit=None, min_count=1):
+    """
+    Returns the values of ``key`` of the hstore ``field`` in the rows of
+    ``queryset`` which have it, with the number of rows which have each, as
+    a list of pairs, most frequent first. Only values found in at least
+    ``min_count`` rows are returned, and at most ``limit`` of them.
+    """
+    return _grouped_counts(queryset, field, 'h->%s', [key], ' WHERE h ? %s', [key], limit, min_count)
+
+
+def _run_threads(functions, max_workers, using):
+    """
+    Calls ``functions`` on at most ``max_workers`` threads, each with its own
+    connections, and returns their results, in order.
+    """
+    results = [None] * len(functions)
+    errors = []
+    tasks = Queue()
+    for task in enumerate(functions):
+        tasks.put(task)
+
+    def work():
+        try:
+            while not errors:
+                try:
+                    i, function = tasks.get_nowait()
+                except Empty:
+                    break
+                try:
+                    results[i] = function()
+                except Exception:
+                    errors.append(sys.exc_info())
+        finally:
+            connections[using].close()
+
+    threads = [threading.Thread(target=work) for i in range(min(max_workers, len(functions)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def count_many(queryset, filters, max_workers=4):
+    """
+    Returns the number of rows of ``queryset`` which match each of
+    ``filters``, which may be HQ or Q objects, in a list. The filters which
+    need no joins are counted together in a single query; any others are
+    counted by separate queries, run on at most ``max_workers`` threads,
+    each with its own connection, so that they do not see changes not yet
+    committed in this one. If ``max_workers`` is 1, they are run in turn on
+    this thread instead.
+    """
+    assert queryset.query.can_filter(), "Cannot filter a query once a slice has been taken"
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    base = queryset.query
+    base.get_initial_alias()
+    qn = base.get_compiler(connection=connection).quote_name_unless_alias
+    select = SortedDict()
+    params = []
+    separate = []
+    for i, filter_ in enumerate(filters):
+        query = base.clone()
+        query.where = query.where_class()
+        query.add_q(filter_)
+        if set(query.alias_map) != set(base.alias_map):
+            separate.append(i)
+            continue
+        try:
+            sql, where_params = query.where.as_sql(qn=qn, connection=connection)
+        except EmptyResultSet:
+            sql, where_params = 'false', []
+        select['count_%d' % i] = 'count(CASE WHEN %s THEN 1 END)' % sql if sql else 'count(*)'
+        params.extend(where_params)
+    counts = [None] * len(filters)
+    if select:
+        row = queryset.extra(select=select, select_params=params).values_list(*select.keys())[0]
+        for name, count in zip(select, row):
+            counts[int(name[len('count_'):])] = count
+    functions = [lambda filter_=filters[i]: queryset.filter(filter_).count() for i in separate]
+    if max_workers > 1:
+        results = _run_threads(functions, max_workers, queryset.db)
+    else:
+        results = [function() for function in functions]
+    for i, count in zip(separate, results):
+        counts[i] = count
+    return counts
+
+
+def _cursor_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, (int, long, decimal.Decimal)):
+        return str(value)
+    else:
+        return value
+
+
+def keyset_page(queryset, field, key, cast=None, cursor=None, size=50, reverse=False):
+    """
+    Returns a page of ``size`` rows of ``queryset``, ordered by the value of
+    ``key`` of the hstore ``field``, cast as given for ``resolve_cast``, and
+    then by primary key, and the cursor of the next page, or None if this is
+    the last. ``cursor`` is the opaque string returned for the previous page,
+    or None for the first. Rather than skip the rows of the previous pages
+    with OFFSET, each page starts after the last row of the previous one, so
+    that, given an index on the cast key and the primary key, its cost does
+    not grow with its depth. Rows which have no value for the key, or none
+    which can be cast, are left out.
+    """
+    assert queryset.query.can_filter(), "Cannot filter a query once a slice has been taken"
+    cast_type = resolve_cast(cast)
+    qn = connections[queryset.db].ops.quote_name
+    model_field = queryset.model._meta.get_field(field)
+    table = qn(model_field.model._meta.db_table)
+    promoted = model_field.promoted.get(key)
+    if cast_type and promoted is not None and can_promote(cast_type, promoted[1]):
+        sql, params = 'CAST(%s.%s AS %s)' % (table, qn(promoted[0]), cast_type), []
+    else:
+        sql, params = cast_sql('%s.%s->%%s' % (table, qn(model_field.column)), cast_type, model_field.safe_casts), [key]
+    pk = '%s.%s' % (qn(queryset.model._meta.db_table), qn(queryset.model._meta.pk.column))
+    where = ['%s IS NOT NULL' % sql]
+    where_params = list(params)
+    if cursor is not None:
+        try:
+            value, last_pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise ValueError('invalid cursor %r' % (cursor,))
+        where.append('(%s, %s) %s (%s, %%s)' % (sql, pk, '<' if reverse else '>', 'CAST(%%s AS %s)' % cast_type if cast_type else '%s'))
+        where_params.extend(params + [value, last_pk])
+    order = ['-_keyset_value', '-pk'] if reverse else ['_keyset_value', 'pk']
+    rows = list(queryset.extra(select={'_keyset_value': sql}, select_params=params, where=where, params=where_params)
+                .order_by(*order)[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    last = rows[-1]
+    next_cursor = base64.urlsafe_b64encode(json.dumps([_cursor_value(last._keyset_value), last.pk]))
+    return rows, next_cursor
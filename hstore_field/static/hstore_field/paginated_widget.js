@@ -0,0 +1,141 @@
+// Pages through the pairs of an hstore for PaginatedHstoreWidget, keeping
+// the pairs edited in the hidden input as {"set": {...}, "delete": [...]}.
+function hstorePages(container) {
+    var input = container.getElementsByTagName('input')[0],
+        tbody = container.getElementsByTagName('tbody')[0],
+        range = container.querySelector('.hstore-range'),
+        url = container.getAttribute('data-url'),
+        pairs = JSON.parse(container.getAttribute('data-pairs')),
+        size = parseInt(container.getAttribute('data-size'), 10),
+        offset = 0,
+        total = 0,
+        diff;
+
+    try {
+        diff = JSON.parse(input.value);
+    } catch (e) {
+        diff = {};
+    }
+    diff.set = diff.set || {};
+    diff['delete'] = diff['delete'] || [];
+    if (!url && pairs === null) {
+        // Redisplayed after a validation error: only the edited pairs are known.
+        pairs = [];
+        for (var key in diff.set) {
+            if (diff.set.hasOwnProperty(key)) {
+                pairs.push([key, null]);
+            }
+        }
+        for (var i = 0; i < diff['delete'].length; i++) {
+            pairs.push([diff['delete'][i], null]);
+        }
+    }
+
+    function save() {
+        input.value = JSON.stringify(diff);
+    }
+
+    function setDeleted(key, deleted) {
+        var index = diff['delete'].indexOf(key);
+        if (deleted && index < 0) {
+            diff['delete'].push(key);
+        } else if (!deleted && index >= 0) {
+            diff['delete'].splice(index, 1);
+        }
+    }
+
+    function cell(tr, element) {
+        var td = document.createElement('td');
+        td.appendChild(element);
+        tr.appendChild(td);
+        return element;
+    }
+
+    function field(value) {
+        var element = document.createElement('input');
+        element.type = 'text';
+        element.value = value;
+        return element;
+    }
+
+    function addRow(key, value) {
+        var tr = document.createElement('tr'),
+            keyInput = cell(tr, key === null ? field('') : document.createTextNode(key)),
+            valueInput = cell(tr, field(key !== null && diff.set.hasOwnProperty(key) ? diff.set[key] : value)),
+            deleted = cell(tr, document.createElement('input'));
+        deleted.type = 'checkbox';
+        deleted.checked = key !== null && diff['delete'].indexOf(key) >= 0;
+        function change() {
+            if (key === null) {
+                return;
+            }
+            if (!deleted.checked && valueInput.value !== value) {
+                diff.set[key] = valueInput.value;
+            } else {
+                delete diff.set[key];
+            }
+            setDeleted(key, deleted.checked);
+            save();
+        }
+        if (key === null) {
+            // A new pair, which is set under its key as it is typed.
+            keyInput.onchange = function () {
+                if (key !== null) {
+                    delete diff.set[key];
+                }
+                key = keyInput.value || null;
+                if (key !== null) {
+                    setDeleted(key, false);
+                    diff.set[key] = valueInput.value;
+                }
+                save();
+            };
+        }
+        valueInput.onchange = deleted.onchange = change;
+        tbody.appendChild(tr);
+    }
+
+    function show(page, count) {
+        var i;
+        total = count;
+        tbody.innerHTML = '';
+        for (i = 0; i < page.length; i++) {
+            addRow(page[i][0], page[i][1]);
+        }
+        range.innerHTML = '';
+        range.appendChild(document.createTextNode(
+            total ? (offset + 1) + '–' + Math.min(offset + size, total) + ' of ' + total : '0 of 0'));
+    }
+
+    function load() {
+        var request;
+        if (!url) {
+            show(pairs.slice(offset, offset + size), pairs.length);
+            return;
+        }
+        request = new XMLHttpRequest();
+        request.open('GET', url + '?offset=' + offset + '&limit=' + size);
+        request.onload = function () {
+            var data = JSON.parse(request.responseText);
+            show(data.pairs, data.total);
+        };
+        request.send();
+    }
+
+    container.querySelector('.hstore-prev').onclick = function () {
+        if (offset > 0) {
+            offset = Math.max(offset - size, 0);
+            load();
+        }
+    };
+    container.querySelector('.hstore-next').onclick = function () {
+        if (offset + size < total) {
+            offset += size;
+            load();
+        }
+    };
+    container.querySelector('.hstore-add').onclick = function () {
+        addRow(null, null);
+    };
+    load();
+}
@@ -0,0 +1,67 @@
+from django.db import connections, DEFAULT_DB_ALIAS
+from .query import _safe_number_patterns
+
+# Patterns of the strings which can be cast to each type; numbers must also
+# be in range of the type, and dates also match the start of timestamps.
+patterns = {
+    'integer': _safe_number_patterns['integer'],
+    'float': _safe_number_patterns['double precision'],
+    'date': r'^[0-9]{4}-[0-9]{2}-[0-9]{2}',
+}
+
+
+def key_stats(model, field, sample=10000, using=DEFAULT_DB_ALIAS):
+    """
+    Returns statistics of the keys of the hstore ``field`` of ``model``, from
+    a sample of about ``sample`` rows, or of every row if ``sample`` is None.
+    On PostgreSQL 9.5 and later the sample is taken with TABLESAMPLE, if the
+    table has been analyzed; otherwise the scan is stopped after ``sample``
+    rows. Returns a list of dictionaries, most frequent key first, giving
+    each ``key``, the ``count`` and ``frequency`` of rows which have it, the
+    number of ``distinct`` values in the sample, and the fraction of its
+    non-empty values which can be cast to ``integer``, ``float`` and ``date``.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    column = qn(model._meta.get_field(field).column)
+    cursor = connection.cursor()
+    source = qn(table)
+    limit = ''
+    params = []
+    if sample is not None:
+        limit = ' LIMIT %d' % sample
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [qn(table)])
+        rows = cursor.fetchone()[0]
+        if connection.connection.server_version >= 90500 and rows > sample:
+            source += ' TABLESAMPLE SYSTEM (%s)'
+            params.append(min(100.0, 100.0 * sample / rows))
+    casts = ''.join(", sum(CASE WHEN (e).value ~ %s THEN 1 ELSE 0 END)" for name in sorted(patterns))
+    sql = ('WITH s AS (SELECT %s AS h FROM %s%s) '
+           'SELECT (e).key, (SELECT count(*) FROM s), count(*), count(DISTINCT (e).value), '
+           'sum(CASE WHEN (e).value <> \'\' THEN 1 ELSE 0 END)%s '
+           'FROM (SELECT each(h) AS e FROM s) p GROUP BY (e).key ORDER BY count(*) DESC, (e).key')
+    cursor.execute(sql % (column, source, limit, casts), params + [patterns[name] for name in sorted(patterns)])
+    result = []
+    for row in cursor.fetchall():
+        key, total, count, distinct, values = row[:5]
+        stats = {'key': key, 'count': count, 'frequency': float(count) / total, 'distinct': distinct}
+        for name, castable in zip(sorted(patterns), row[5:]):
+            stats[name] = float(castable) / values if values else 0.0
+        result.append(stats)
+    return result
+
+
+def recommend_cast(stats):
+    """
+    Returns the cast of the expression index which would serve range queries
+    on a key with the given statistics, or None if its values should be
+    compared as strings. A cast is only recommended if every value of the
+    sample can be cast, since one that cannot makes the query fail.
+    """
+    if stats['integer'] == 1.0:
+        return 'integer'
+    elif stats['float'] == 1.0:
+        return 'double precision'
+    else:
+        return None
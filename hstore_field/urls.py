@@ -0,0 +1,5 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('hstore_field.views',
+    url(r'^(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<field>\w+)/(?P<pk>[^/]+)/$', 'page', name='hstore_field_page'),
+)
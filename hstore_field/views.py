@@ -0,0 +1,34 @@
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import get_model
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from .fields import HStoreField
+from .query import hstore_page
+
+
+def page(request, app_label, model_name, field, pk):
+    """
+    Serves a page of the pairs of the hstore ``field`` of an instance, as
+    JSON, for PaginatedHstoreWidget. Requires the permission to change the
+    instance.
+    """
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise Http404
+    if field not in [f.name for f in model._meta.fields if isinstance(f, HStoreField)]:
+        raise Http404
+    opts = model._meta
+    if not (request.user.is_active and request.user.is_staff and
+            request.user.has_perm('%s.%s' % (opts.app_label, opts.get_change_permission()))):
+        return HttpResponseForbidden()
+    try:
+        pk = opts.pk.to_python(pk)
+        offset = max(int(request.GET.get('offset', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', 100)), 1), 1000)
+    except (ValidationError, ValueError):
+        return HttpResponseBadRequest()
+    result = hstore_page(model, field, pk, offset, limit)
+    if result is None:
+        raise Http404
+    total, pairs = result
+    return HttpResponse(json.dumps({'total': total, 'pairs': pairs}), content_type='application/json')
@@ -8,7 +8,7 @@ setup(
     author='Eric Russell, Anant Asthana',
     author_email='erussell@pobox.com,anant.asty@gmail.com',
     url='http://github.com/erussell/hstore-field',
-    packages=['hstore_field'],
+    packages=['hstore_field', 'hstore_field.management', 'hstore_field.management.commands'],
     include_package_data=True,
     license='BSD',
     classifiers=[
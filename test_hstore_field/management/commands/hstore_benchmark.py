@@ -0,0 +1,127 @@
+import json
+import platform
+import random
+import sys
+import time
+from optparse import make_option
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from hstore_field import bulk
+from hstore_field.fields import DatabaseDictionary
+from hstore_field.query import add_hstore, HQ
+from test_hstore_field import models
+
+
+def timed(function, number=1, repeat=3):
+    """
+    Returns the best time, in seconds, of ``repeat`` runs of ``number`` calls
+    of ``function``, divided by ``number``.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            function()
+        times.append(time.time() - start)
+    return min(times) / number
+
+
+def make_data(i, size):
+    data = {'a': str(i % 1000), 'c': str(i % 100 / 100.0), 'g': random.choice(['Apple', 'Dog', 'Car'])}
+    for k in range(size - len(data)):
+        data['key%d' % k] = 'value %d' % random.randint(0, 1000)
+    return data
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the read, write and query paths of hstore-field in a test database, and writes the results as JSON."
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=10000, help='Number of rows to query.'),
+        make_option('--size', type='int', default=50, help='Number of keys in each row.'),
+        make_option('--repeat', type='int', default=3, help='Number of times to repeat each measurement.'),
+        make_option('--output', default=None, help='File to write the results to, instead of stdout.'),
+    )
+
+    def handle(self, **options):
+        self.repeat = options['repeat']
+        self.results = []
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.bench_conversion()
+            self.bench_compile()
+            self.bench_bulk(options['rows'], options['size'])
+            self.bench_queries(options['rows'], options['size'])
+            server_version = connection.connection.server_version
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        report = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'postgresql': server_version,
+            'results': self.results,
+        }
+        output = open(options['output'], 'w') if options['output'] else sys.stdout
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+    def record(self, name, seconds, **params):
+        self.results.append({'name': name, 'seconds': seconds, 'params': params})
+
+    def bench_conversion(self):
+        field = models.Item._meta.get_field('data')
+        for size in (10, 100, 1000):
+            data = make_data(0, size)
+            typed = dict((k, float(i)) for i, k in enumerate(data))
+            self.record('to_python', timed(lambda: field.to_python(dict(data)), 1000, self.repeat), size=size)
+            self.record('get_prep_value', timed(lambda: field.get_prep_value(data), 1000, self.repeat), size=size, values='str')
+            self.record('get_prep_value', timed(lambda: field.get_prep_value(typed), 1000, self.repeat), size=size, values='float')
+            # Values assigned by the application are validated and encoded;
+            # values read from the database are wrapped as they are.
+            self.record('load', timed(lambda: models.Item(id=1, name='a', data=dict(data)), 1000, self.repeat), size=size, source='assigned')
+            self.record('load', timed(lambda: models.Item(id=1, name='a', data=DatabaseDictionary(data)), 1000, self.repeat), size=size, source='database')
+            self.record('load', timed(lambda: models.CompactItem(id=1, name='a', data=DatabaseDictionary(data)), 1000, self.repeat), size=size, source='compact')
+
+    def bench_compile(self):
+        queries = {
+            'exact': lambda: HQ(data__a='1'),
+            'range': lambda: HQ(data__a__lt=1),
+            'combined': lambda: HQ(data__a='1', data__g='Dog') & ~HQ(data__c__gte=0.5),
+            'related': lambda: HQ(item__data__a__lt=1),
+        }
+        for name, hq in sorted(queries.iteritems()):
+            model = models.Related if name == 'related' else models.Item
+            compile_query = lambda: model.objects.filter(hq()).query.get_compiler(connection=connection).as_sql()
+            self.record('compile', timed(compile_query, 1000, self.repeat), query=name)
+
+    def bench_bulk(self, rows, size):
+        objs = [models.Item(name=str(i), data=make_data(i, size)) for i in range(rows)]
+
+        def copy_insert():
+            bulk.copy_insert(models.Item, iter(objs))
+            models.Item.objects.all().delete()
+
+        def bulk_create():
+            models.Item.objects.bulk_create(objs, batch_size=1000)
+            models.Item.objects.all().delete()
+        self.record('insert', timed(copy_insert, 1, self.repeat), method='copy_insert', rows=rows, size=size)
+        self.record('insert', timed(bulk_create, 1, self.repeat), method='bulk_create', rows=rows, size=size)
+
+    def bench_queries(self, rows, size):
+        queries = {
+            'contains': lambda: HQ(data__contains='a'),
+            'contains_pairs': lambda: HQ(data__contains={'a': '1', 'g': 'Dog'}),
+            'exact': lambda: HQ(data__g='Dog'),
+            'in': lambda: HQ(data__g__in=['Dog', 'Car']),
+            'int_range': lambda: HQ(data__a__lt=10),
+            'float_range': lambda: HQ(data__c__gte=0.99),
+        }
+        for model, indexed in ((models.Item, False), (models.IndexedItem, True)):
+            bulk.copy_insert(model, (model(name=str(i), data=make_data(i, size)) for i in xrange(rows)))
+            connection.cursor().execute('ANALYZE %s' % connection.ops.quote_name(model._meta.db_table))
+            for name, hq in sorted(queries.iteritems()):
+                self.record('query', timed(lambda: model.objects.filter(hq()).count(), 10, self.repeat), query=name, indexed=indexed, rows=rows, size=size)
+            load = lambda: list(model.objects.all()[:1000])
+            self.record('load_rows', timed(load, 1, self.repeat) / min(rows, 1000), indexed=indexed, rows=rows, size=size)
+            extract = lambda: list(add_hstore(model.objects.all(), 'data', 'a').values_list('a', flat=True))
+            self.record('add_hstore', timed(extract, 1, self.repeat), indexed=indexed, rows=rows, size=size)
@@ -1,7 +1,9 @@
+import datetime
 from django.contrib import admin
 from django.contrib.gis.admin import OSMGeoAdmin
 from django.contrib.gis.db import models
 from hstore_field import fields
+from hstore_field.admin import HStoreAdminMixin
 
 
 class Item (models.Model):
@@ -10,6 +12,15 @@ class Item (models.Model):
 admin.site.register(Item)
 
 
+class ChildItem (Item):
+    kind = models.CharField(max_length=64)
+
+
+class ProxyItem (Item):
+    class Meta:
+        proxy = True
+
+
 class Related (models.Model):
     item = models.ForeignKey(Item)
 admin.site.register(Related)
@@ -21,3 +32,42 @@ class GeoItem (models.Model):
     data = fields.HStoreField()
     objects = models.GeoManager()
 admin.site.register(GeoItem, OSMGeoAdmin)
+
+
+class TypedItem (models.Model):
+    name = models.CharField(max_length=64)
+    data = fields.HStoreField(schema={'price': float, 'count': int, 'ts': datetime.datetime, 'day': datetime.date, 'ok': bool})
+
+
+class IndexedItem (models.Model):
+    name = models.CharField(max_length=64)
+    data = fields.HStoreField(index='gin', key_indexes={'a': 'integer', 'c': 'double precision', 'g': None})
+
+
+class LenientItem (models.Model):
+    name = models.CharField(max_length=64)
+    data = fields.HStoreField(safe_casts=True, key_indexes={'a': 'integer', 'd': 'date'})
+
+
+class PromotedItem (models.Model):
+    name = models.CharField(max_length=64)
+    data = fields.HStoreField(promote={'price': models.FloatField(db_index=True), 'day': models.DateField()})
+
+
+class TrackedItem (fields.SkipUnchangedHStoreMixin, models.Model):
+    name = models.CharField(max_length=64)
+    data = fields.HStoreField()
+
+
+class TrackedChildItem (TrackedItem):
+    kind = models.CharField(max_length=64)
+
+
+class CompactItem (models.Model):
+    name = models.CharField(max_length=64)
+    data = fields.HStoreField(compact=True, schema={'count': int})
+
+
+class CompactItemAdmin (HStoreAdminMixin, admin.ModelAdmin):
+    hstore_page_size = 10
+admin.site.register(CompactItem, CompactItemAdmin)
@@ -116,6 +116,7 @@ INSTALLED_APPS = (
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.gis',
+    'hstore_field',
     'test_hstore_field',
     'django.contrib.admin',
 )
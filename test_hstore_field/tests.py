@@ -1,8 +1,15 @@
 from . import models
 from django import test
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.db.models import Q
-from hstore_field.query import add_hstore, HQ
+from django.forms import ModelForm
+from hstore_field import bulk, fields, forms, instrumentation, stats
+from hstore_field.query import lookup_cache, add_hstore, add_hstore_keys, count_many, delete_keys, hstore_page, increment_key, key_counts, keyset_page, only_keys, set_keys, value_counts, HQ, HAvg, HMax, HMin, HSum
 import datetime
+import json
 
 
 class HStoreTest(test.TestCase):
@@ -32,6 +39,15 @@ class HStoreTest(test.TestCase):
             self.assertEqual(a.data['x'], str(x))
             self.assertEqual(a.data['y'], str(y))
 
+    def test_batch_encoding(self):
+        class Point(object):
+            def to_hstore(self):
+                return '1,2'
+        d = datetime.date(2012, 1, 1)
+        values = [{'a': 1, 'b': 'x', 'c': None}, {'d': d, 'e': Point(), 'f': True, 'g': 1.5}]
+        self.assertEqual(forms.encode(values), [{'a': '1', 'b': 'x', 'c': ''}, {'d': '2012-01-01', 'e': '1,2', 'f': 'True', 'g': '1.5'}])
+        self.assertRaises(TypeError, forms.encode, {'a': object()})
+
     def test_encoding_error(self):
         for model in (models.Item, models.GeoItem):
             def encode_list():
@@ -152,3 +168,475 @@ class HStoreTest(test.TestCase):
             self.assertNotEqual(model.objects.filter(HQ(data__g='dog')).count(), 0)
             self.assertEqual(model.objects.filter(HQ(data__g__iexact='car')).count(), 1)
             self.assertNotEqual(model.objects.filter(HQ(data__g='car')).count(), 0)
+
+    def test_indexes(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s", [models.IndexedItem._meta.db_table])
+        indexes = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(any('USING gin (data)' in index for index in indexes))
+        self.assertEqual(len(indexes), 5)
+        field = models.IndexedItem._meta.get_field('data')
+        statements = field.sql_indexes(models.IndexedItem, connection)
+        self.assertTrue(any("((CAST(NULLIF(\"data\"->'a','') AS integer)))" in statement for statement in statements))
+        self.assertRaises(ValueError, fields.HStoreField, key_indexes={'d': 'timestamp'})
+        self.assertRaises(ValueError, fields.HStoreField, index='btree')
+
+    def test_partial_save(self):
+        a = models.Item.objects.create(name='a', data={'a': '1', 'b': '2', 'c': '3'})
+        other = models.Item.objects.get(pk=a.pk)
+        other.data['z'] = '26'
+        other.save()
+        a = models.Item.objects.get(pk=a.pk)
+        self.assertEqual(a.data, {'a': '1', 'b': '2', 'c': '3', 'z': '26'})
+        concurrent = models.Item.objects.get(pk=a.pk)
+        concurrent.data['y'] = 25
+        concurrent.save()
+        a.data['a'] = 10
+        del a.data['b']
+        a.save()
+        self.assertEqual(a.data.changed_keys, set())
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': '10', 'c': '3', 'y': '25', 'z': '26'})
+        a.data = {'x': '1'}
+        a.save()
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'x': '1'})
+
+    def test_queryset_updates(self):
+        self._create_items(models.Item)
+        self.assertEqual(set_keys(models.Item.objects.filter(HQ(data__a__lt=3)), 'data', {'h': 1, 'a': '0'}), 2)
+        self.assertEqual(models.Item.objects.filter(HQ(data__h='1')).count(), 2)
+        self.assertEqual(models.Item.objects.filter(HQ(data__a='0')).count(), 2)
+        self.assertEqual(delete_keys(models.Item.objects.all(), 'data', ['g', 'h']), 3)
+        self.assertEqual(models.Item.objects.filter(HQ(data__contains='g')).count(), 0)
+        self.assertEqual(models.Item.objects.get(name='c').data['b'], '6')
+        increment_key(models.Item.objects.all(), 'data', 'b', 2)
+        increment_key(models.Item.objects.filter(name='a'), 'data', 'n')
+        increment_key(models.Item.objects.filter(name='a'), 'data', 'c', 0.5)
+        item = models.Item.objects.get(name='a')
+        self.assertEqual((item.data['b'], item.data['n'], item.data['c']), ('6', '1', '0.5'))
+        self.assertEqual(models.Item.objects.get(name='c').data['b'], '8')
+        for key in ("it's", '5%', 'back\\slash'):
+            increment_key(models.Item.objects.filter(name='a'), 'data', key, 3)
+            self.assertEqual(models.Item.objects.filter(HQ(**{'data__%s__gt' % key: 2})).count(), 1)
+            self.assertEqual(models.Item.objects.filter(HQ(**{'data__%s__iexact' % key: '3'})).count(), 1)
+
+    def test_copy_insert(self):
+        data = {'a': 'quote " and backslash \\', 'b': 'tab\tnewline\n', 'c': 1, 'd': None}
+        items = (models.Item(name='item %d' % i, data=data) for i in range(1000))
+        self.assertEqual(bulk.copy_insert(models.Item, items, size=1024), 1000)
+        self.assertEqual(models.Item.objects.count(), 1000)
+        item = models.Item.objects.get(name='item 999')
+        self.assertEqual(item.data, {'a': 'quote " and backslash \\', 'b': 'tab\tnewline\n', 'c': '1', 'd': ''})
+        self.assertEqual(bulk.hstore_text({'a': None}), '"a"=>NULL')
+        loaded = models.Item.objects.create(name='caf\xc3\xa9', data={'caf\xc3\xa9': 'na\xc3\xafve'})
+        loaded = models.Item.objects.get(pk=loaded.pk)
+        self.assertEqual(bulk.copy_insert(models.Item, [models.Item(name=loaded.name, data=loaded.data)]), 1)
+        self.assertEqual(models.Item.objects.filter(name=u'caf\xe9').filter(HQ(data__contains={'caf\xc3\xa9': 'na\xc3\xafve'})).count(), 2)
+
+    def test_oid_cache(self):
+        fields.clear_hstore_oids('default')
+        self.assertFalse(any(alias == 'default' for alias, dsn in fields._hstore_oids))
+        connection.close()
+        models.Item.objects.create(name='a', data={'a': '1'})
+        key = ('default', connection.connection.dsn)
+        oids = fields._hstore_oids[key]
+        connection.close()
+        self.assertEqual(models.Item.objects.get(name='a').data, {'a': '1'})
+        self.assertTrue(fields._hstore_oids[key] is oids)
+
+    def test_database_settings(self):
+        self.assertEqual(fields.hstore_settings('other'), {'ddl': True, 'globally': True, 'oids': None})
+        with self.settings(HSTORE_DATABASES={'default': {'globally': False}}):
+            self.assertEqual(fields.hstore_settings('other'), None)
+            self.assertEqual(fields.hstore_settings('default')['globally'], False)
+            fields.clear_hstore_oids('default')
+            connection.close()
+            models.Item.objects.create(name='a', data={'a': '1'})
+            oids = fields._hstore_oids[('default', connection.connection.dsn)]
+            connection.close()
+            self.assertEqual(models.Item.objects.get(name='a').data, {'a': '1'})
+            self.assertTrue(fields._hstore_oids[('default', connection.connection.dsn)] is oids)
+        fields.clear_hstore_oids('default')
+        connection.close()
+
+    def test_typed_schema(self):
+        ts = datetime.datetime(2012, 1, 1, 0, 15, 30)
+        models.TypedItem.objects.create(name='a', data={'price': 1.5, 'count': 3, 'ts': ts, 'day': ts.date(), 'ok': True, 'name': 'x'})
+        item = models.TypedItem.objects.get(name='a')
+        self.assertEqual(dict.__getitem__(item.data, 'price'), '1.5')
+        self.assertEqual(item.data.decoded, {})
+        self.assertEqual(item.data['price'], 1.5)
+        self.assertEqual(item.data.decoded, {'price': 1.5})
+        self.assertEqual(item.data.get('count'), 3)
+        self.assertEqual(item.data['ts'], ts)
+        self.assertEqual(item.data['day'], ts.date())
+        self.assertEqual(item.data['ok'], True)
+        self.assertEqual(item.data['name'], 'x')
+        item.data['count'] = 4
+        self.assertEqual(item.data['count'], 4)
+        item.save()
+        self.assertEqual(models.TypedItem.objects.get(name='a').data['count'], 4)
+
+    def test_only_keys(self):
+        for model in (models.Item, models.GeoItem):
+            self._create_items(model)
+            items = only_keys(model.objects.filter(HQ(data__a__lt=3)), 'data', ['a', 'g', 'z']).order_by('name')
+            self.assertEqual([dict(item.data) for item in items], [{'a': '1', 'g': 'Apple'}, {'a': '2', 'g': 'Dog'}])
+            item = items[0]
+            self.assertEqual(item.data['a'], '1')
+            self.assertFalse('z' in item.data)
+            self.assertRaises(KeyError, lambda: item.data['z'])
+            self.assertRaises(fields.UnloadedKeyError, lambda: item.data['b'])
+            self.assertRaises(TypeError, item.data.__setitem__, 'a', '2')
+            item.name = 'renamed'
+            item.save()
+            self.assertEqual(model.objects.get(name='renamed').data['b'], '4')
+
+    def test_inherited_only_keys(self):
+        models.ChildItem.objects.create(name='b', kind='c', data={'a': '2', 'b': '5'})
+        item = only_keys(models.ChildItem.objects.all(), 'data', ['a'])[0]
+        self.assertEqual((item.kind, item.data['a']), ('c', '2'))
+        self.assertRaises(fields.UnloadedKeyError, lambda: item.data['b'])
+
+    def test_extra_keys_query(self):
+        for model in (models.Item, models.GeoItem):
+            self._create_items(model)
+            items = add_hstore_keys(model.objects.all(), 'data', {'a': ('a', int), 'c': ('c', float), 'g': 'g'}).order_by('-c')
+            self.assertEqual([(item.a, item.c, item.g) for item in items], [(3, 0.66, 'Car'), (2, 0.33, 'Dog'), (1, 0.0, 'Apple')])
+            self.assertEqual(add_hstore_keys(model.objects.all(), 'data', {'e': ('e', datetime.date)}).order_by('e')[0].e, datetime.date(2012, 1, 1))
+
+    def test_inherited_extra_keys_query(self):
+        models.ChildItem.objects.create(name='b', kind='c', data={'a': '2', 'b': '5'})
+        item = add_hstore_keys(models.ChildItem.objects.all(), 'data', {'a': ('a', int), 'b': 'b'})[0]
+        self.assertEqual((item.a, item.b), (2, '5'))
+        self.assertEqual(add_hstore(models.ChildItem.objects.all(), 'data', 'a')[0].a, '2')
+
+    def test_aggregate_query(self):
+        for model in (models.Item, models.GeoItem):
+            self._create_items(model)
+            result = model.objects.filter(HQ(data__a__gt=1)).aggregate(HMax('data', 'e', datetime.date), total=HSum('data', 'a', int), average=HAvg('data', 'c', float))
+            self.assertEqual(result['total'], 5)
+            self.assertAlmostEqual(result['average'], 0.495)
+            self.assertEqual(result['data__e__max'], datetime.date(2012, 2, 2))
+            self.assertEqual(model.objects.filter(HQ(data__a__gt=1)).aggregate(HMin('data', 'g'))['data__g__min'], 'Car')
+
+    def test_containment_query(self):
+        for model in (models.Item, models.GeoItem):
+            self._create_items(model)
+            self.assertEqual(model.objects.filter(HQ(data__contains={'a': '1', 'b': '4'})).count(), 1)
+            self.assertEqual(model.objects.filter(HQ(data__contains={'a': 1, 'b': 5})).count(), 0)
+            self.assertEqual(model.objects.filter(HQ(data__any=['a', 'z'])).count(), 3)
+            self.assertEqual(model.objects.filter(HQ(data__any=['y', 'z'])).count(), 0)
+            query = model.objects.filter(HQ(data__a='2', data__b='5', data__c__lt=1)).query
+            self.assertTrue('@>' in str(query))
+            self.assertEqual(model.objects.filter(HQ(data__a='2', data__b='5', data__c__lt=1)).count(), 1)
+            self.assertEqual(model.objects.filter(~HQ(data__a='2', data__b='5')).count(), 2)
+        self.assertFalse('@>' in str(models.LenientItem.objects.filter(HQ(data__a='2', data__d='2012-01-01')).query))
+        self.assertTrue('@>' in str(models.IndexedItem.objects.filter(HQ(data__a='2', data__g='Dog')).query))
+
+    def test_lookup_cache(self):
+        self._create_items(models.Item)
+        lookup_cache.clear()
+        for i in range(3):
+            self.assertEqual(models.Item.objects.filter(HQ(data__a__lt=2)).count(), 1)
+            self.assertEqual(models.Related.objects.filter(HQ(item__data__a=1)).count(), 0)
+        self.assertEqual((lookup_cache.hits, lookup_cache.misses), (4, 2))
+
+    def test_instrumentation(self):
+        self._create_items(models.Item)
+        sink = instrumentation.RingBufferSink(size=10)
+        instrumentation.add_sink(sink)
+        instrumentation.time_queries(explain=True)
+        try:
+            self.assertEqual(models.Item.objects.filter(name='a').filter(~HQ(data__a__lt=2)).count(), 0)
+        finally:
+            instrumentation.stop_timing_queries()
+            instrumentation.remove_sink(sink)
+        compiled, executed = sink.events
+        predicate = {'alias': models.Item._meta.db_table, 'column': 'data', 'key': 'a', 'lookup_type': 'lt', 'cast_type': 'integer'}
+        self.assertEqual((compiled['event'], compiled['predicates']), ('compile', [predicate]))
+        self.assertEqual((executed['event'], executed['predicates']), ('execute', [predicate]))
+        self.assertEqual(executed['seq_scans'], [models.Item._meta.db_table])
+        self.assertFalse('hstore:' in str(models.Item.objects.filter(HQ(data__a__lt=2)).query))
+
+    def test_database_values(self):
+        a = models.Item.objects.create(name='a', data={'a': '1', 'b': None})
+        cursor = connection.cursor()
+        cursor.execute('SELECT data FROM %s WHERE id = %%s' % models.Item._meta.db_table, [a.pk])
+        value = cursor.fetchone()[0]
+        self.assertTrue(isinstance(value, fields.DatabaseDictionary))
+        item = models.Item.objects.get(pk=a.pk)
+        self.assertTrue(isinstance(item.data, fields.HStoreDictionary))
+        self.assertEqual(item.data, {'a': '1', 'b': ''})
+        cursor.execute("UPDATE %s SET data = data || hstore('c', NULL::text) WHERE id = %%s" % models.Item._meta.db_table, [a.pk])
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': '1', 'b': '', 'c': ''})
+
+    def test_iter_hstore(self):
+        for model in (models.Item, models.GeoItem):
+            a, b, c = self._create_items(model)
+            pairs = list(bulk.iter_hstore(model.objects.filter(HQ(data__a__lt=3)).order_by('pk'), 'data', chunk_size=1))
+            self.assertEqual([(pk, dict(data)) for pk, data in pairs], [(a.pk, a.data), (b.pk, b.data)])
+            self.assertTrue(isinstance(pairs[0][1], fields.HStoreDictionary))
+            items = list(bulk.iter_hstore(model.objects.order_by('pk'), chunk_size=2))
+            self.assertEqual(items, [a, b, c])
+            self.assertEqual(items[2].data, c.data)
+            items[2].data['h'] = '1'
+            items[2].save()
+            self.assertEqual(model.objects.get(pk=c.pk).data['h'], '1')
+            for empty in (model.objects.filter(pk__in=[]), model.objects.none()):
+                self.assertEqual(list(bulk.iter_hstore(empty)), [])
+                self.assertEqual(list(bulk.iter_hstore(empty, 'data')), [])
+
+    def test_key_stats(self):
+        self._create_items(models.Item)
+        models.Item.objects.create(name='d', data={'a': '', 'c': 'x', 'h': '99999999999', 'i': '1e999'})
+        result = dict((row['key'], row) for row in stats.key_stats(models.Item, 'data', sample=100))
+        self.assertEqual(result['a']['count'], 4)
+        self.assertEqual(result['a']['frequency'], 1.0)
+        self.assertEqual(result['g']['frequency'], 0.75)
+        self.assertEqual(result['g']['distinct'], 3)
+        self.assertEqual(result['a']['integer'], 1.0)
+        self.assertEqual(result['c']['float'], 0.75)
+        self.assertEqual(result['e']['date'], 1.0)
+        self.assertEqual(stats.recommend_cast(result['a']), 'integer')
+        self.assertEqual(stats.recommend_cast(result['b']), 'integer')
+        self.assertEqual(stats.recommend_cast(result['c']), None)
+        self.assertEqual(stats.recommend_cast(result['g']), None)
+        self.assertEqual(stats.recommend_cast(result['h']), 'double precision')
+        self.assertEqual(stats.recommend_cast(result['i']), None)
+
+    def test_safe_casts(self):
+        for i, value in enumerate(['1', '2', 'x', '', '99999999999', '1.5']):
+            models.LenientItem.objects.create(name=str(i), data={'a': value, 'd': '2012-01-0%d' % (i + 1), 'c': value})
+        models.LenientItem.objects.create(name='bad', data={'d': '2012-13-45', 'c': '1e999'})
+        models.LenientItem.objects.create(name='big', data={'a': ' 2000000000 ', 'c': '1e100'})
+        models.LenientItem.objects.create(name='today', data={'d': 'today'})
+        models.LenientItem.objects.create(name='us', data={'d': '01/02/2099'})
+        names = lambda hq: sorted(models.LenientItem.objects.filter(hq).values_list('name', flat=True))
+        self.assertEqual(names(HQ(data__a__lt=3)), ['0', '1'])
+        self.assertEqual(names(HQ(data__a__gt=1999999999)), ['big'])
+        self.assertEqual(names(HQ(data__c__gte=1.5)), ['1', '4', '5', 'big'])
+        self.assertEqual(names(HQ(data__d__gt=datetime.date(2012, 1, 4))), ['4', '5'])
+        cursor = connection.cursor()
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s", [models.LenientItem._meta.db_table])
+        indexes = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(any('hstore_field_date' in index for index in indexes))
+        self.assertRaises(ValueError, fields.HStoreField, key_indexes={'d': 'date'})
+
+    def test_promote(self):
+        a = models.PromotedItem.objects.create(name='a', data={'price': 1.5, 'day': datetime.date(2012, 1, 1)})
+        b = models.PromotedItem.objects.create(name='b', data={'price': 'x'})
+        bulk.copy_insert(models.PromotedItem, [models.PromotedItem(name='c', data={'price': '10'})])
+        self.assertEqual(a.data_price, 1.5)
+        self.assertEqual(b.data_price, None)
+        self.assertEqual(models.PromotedItem.objects.get(name='c').data_price, 10.0)
+        b.data['price'] = 3
+        b.save()
+        self.assertEqual(b.data_price, 3.0)
+        self.assertEqual(models.PromotedItem.objects.get(pk=b.pk).data_price, 3.0)
+        set_keys(models.PromotedItem.objects.filter(pk=a.pk), 'data', {'price': 2})
+        queryset = models.PromotedItem.objects.filter(HQ(data__price__lt=5))
+        self.assertTrue('"data_price" <' in str(queryset.query))
+        self.assertEqual(sorted(queryset.values_list('name', flat=True)), ['a', 'b'])
+        self.assertEqual(models.PromotedItem.objects.filter(HQ(data__day=datetime.date(2012, 1, 1))).count(), 1)
+        self.assertEqual(models.PromotedItem.objects.aggregate(HMax('data', 'price', float))['data__price__max'], 10.0)
+        queryset = add_hstore_keys(models.PromotedItem.objects.all(), 'data', {'price': ('price', float)}).order_by('price')
+        self.assertEqual(list(queryset.values_list('name', flat=True)), ['a', 'b', 'c'])
+
+    def test_inherited_partial_save(self):
+        for model in (models.ChildItem, models.ProxyItem):
+            a = model.objects.create(name='a', data={'a': '1'})
+            a = model.objects.get(pk=a.pk)
+            a.data['a'] = '2'
+            a.save()
+            models.Item.objects.filter(pk=a.pk).update(data={'a': '2', 'b': '3'})
+            a.data['a'] = '1'
+            a.save()
+            self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': '1', 'b': '3'})
+
+    def test_update_fields_save(self):
+        a = models.Item.objects.create(name='a', data={'a': '1'})
+        a.data['b'] = '2'
+        a.name = 'b'
+        a.save(update_fields=['name'])
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': '1'})
+        a.save()
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': '1', 'b': '2'})
+
+    def test_unchanged_save(self):
+        a = models.TrackedItem.objects.create(name='a', data={'a': '1', 'b': '2'})
+        a = models.TrackedItem.objects.get(pk=a.pk)
+        field = models.TrackedItem._meta.get_field('data')
+        self.assertFalse(field.has_changed(a))
+        a.data['a'] = 1
+        a.data['c'] = '3'
+        del a.data['c']
+        self.assertFalse(field.has_changed(a))
+        a.data = {'a': '1', 'b': '2'}
+        self.assertFalse(field.has_changed(a))
+        models.TrackedItem.objects.filter(pk=a.pk).update(data={'z': '26'})
+        a.name = 'b'
+        a.save()
+        b = models.TrackedItem.objects.get(pk=a.pk)
+        self.assertEqual((b.name, b.data), ('b', {'z': '26'}))
+        a.data['a'] = '2'
+        self.assertTrue(field.has_changed(a))
+        a.save()
+        self.assertFalse(field.has_changed(a))
+        self.assertEqual(models.TrackedItem.objects.get(pk=a.pk).data, {'a': '2', 'z': '26'})
+
+    def test_inherited_unchanged_save(self):
+        a = models.TrackedChildItem.objects.create(name='a', data={'a': '1'})
+        a = models.TrackedChildItem.objects.get(pk=a.pk)
+        field = models.TrackedChildItem._meta.get_field('data')
+        a.data['a'] = '2'
+        a.save()
+        self.assertFalse(field.has_changed(a))
+        models.TrackedItem.objects.filter(pk=a.pk).update(data={'a': '2', 'z': '26'})
+        a.data['a'] = '1'
+        self.assertTrue(field.has_changed(a))
+        a.save()
+        self.assertEqual(models.TrackedItem.objects.get(pk=a.pk).data, {'a': '1', 'z': '26'})
+
+    def test_compact(self):
+        a = models.CompactItem.objects.create(name='a', data={'a': '1', 'count': 2})
+        models.CompactItem.objects.create(name='b', data={'a': '3', 'count': 4})
+        a, b = models.CompactItem.objects.order_by('name')
+        self.assertTrue(isinstance(a.data, fields.CompactHStoreDictionary))
+        self.assertTrue(a.data.layout is b.data.layout)
+        self.assertFalse(hasattr(a.data, '__dict__'))
+        self.assertEqual(a.data, {'a': '1', 'count': '2'})
+        self.assertEqual(a.data, fields.CompactHStoreDictionary({'a': '1', 'count': '2'}))
+        self.assertNotEqual(a.data, {'a': '1', 'count': 2})
+        self.assertEqual(sorted(a.data.items()), [('a', '1'), ('count', 2)])
+        self.assertTrue('a' in a.data and 'z' not in a.data)
+        self.assertEqual(a.data.get('z'), None)
+        self.assertRaises(KeyError, lambda: a.data['z'])
+        data = a.data
+        data['z'] = '26'
+        self.assertTrue(isinstance(a.data, fields.TypedHStoreDictionary))
+        self.assertEqual(data['z'], '26')
+        self.assertEqual((data, a.data), ({'a': '1', 'count': '2', 'z': '26'},) * 2)
+        self.assertNotEqual(a.data, {'a': '1', 'count': 2, 'z': '26'})
+        self.assertEqual(a.data.changed_keys, set(['z']))
+        models.CompactItem.objects.filter(pk=a.pk).update(data={'a': '1', 'count': '2', 'y': '25'})
+        a.save()
+        b.name = 'c'
+        b.save()
+        self.assertEqual(models.CompactItem.objects.get(pk=a.pk).data, {'a': '1', 'count': '2', 'y': '25', 'z': '26'})
+        self.assertEqual(models.CompactItem.objects.get(pk=b.pk).data, {'a': '3', 'count': '4'})
+        pairs = dict(bulk.iter_hstore(models.CompactItem.objects.all(), 'data'))
+        self.assertTrue(isinstance(pairs[b.pk], fields.CompactHStoreDictionary))
+
+    def test_paginated_form(self):
+        a = models.CompactItem.objects.create(name='a', data=dict(('k%03d' % i, str(i)) for i in range(120)))
+        total, pairs = hstore_page(models.CompactItem, 'data', a.pk, 100, 50)
+        self.assertEqual(total, 120)
+        self.assertEqual(pairs, [('k%03d' % i, str(i)) for i in range(100, 120)])
+        self.assertEqual(hstore_page(models.CompactItem, 'data', a.pk + 1), None)
+        field = forms.HstoreDiffField()
+        self.assertRaises(ValidationError, field.clean, '{"set": []}')
+        self.assertRaises(ValidationError, field.clean, '[]')
+        self.assertRaises(ValidationError, field.clean, '{"set": {"a": [1]}}')
+        self.assertEqual(field.clean('{"set": {"a": 1, "b": "x"}}').changes, {'a': 1, 'b': 'x'})
+        self.assertFalse(field.clean(''))
+        html = forms.PaginatedHstoreWidget(url='/pages/').render('data', a.data)
+        self.assertTrue('data-url="/pages/"' in html and 'k001' not in html)
+        self.assertTrue('k001' in forms.PaginatedHstoreWidget().render('data', {'k001': '1'}))
+        url = reverse('hstore_field_page', kwargs={'app_label': 'test_hstore_field', 'model_name': 'compactitem', 'field': 'data', 'pk': a.pk})
+        self.assertEqual(self.client.get(url).status_code, 403)
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = json.loads(self.client.get(url, {'offset': 10, 'limit': 10}).content)
+        self.assertEqual(response['total'], 120)
+        self.assertEqual(response['pairs'][0], ['k010', '10'])
+        models.CompactItem.objects.filter(pk=a.pk).update(data=dict(a.data.to_dict(), k200='200'))
+        response = self.client.post(reverse('admin:test_hstore_field_compactitem_change', args=[a.pk]),
+                                    {'name': 'b', 'data': '{"set": {"k000": "x", "new": "1"}, "delete": ["k001"]}'})
+        self.assertEqual(response.status_code, 302)
+        a = models.CompactItem.objects.get(pk=a.pk)
+        self.assertEqual((a.name, a.data['k000'], a.data['new'], a.data['k200'], 'k001' in a.data, len(a.data)), ('b', 'x', '1', '200', False, 121))
+
+    def test_form_save(self):
+        class ItemForm(ModelForm):
+            data = forms.HstoreDiffField(widget=forms.PaginatedHstoreWidget())
+
+            class Meta:
+                model = models.Item
+                fields = ('name', 'data')
+        a = models.Item.objects.create(name='a', data={'a': '1', 'b': '2'})
+        a = models.Item.objects.get(pk=a.pk)
+        form = ItemForm({'name': 'b', 'data': '{"set": {"a": "x"}, "delete": ["b"]}'}, instance=a)
+        models.Item.objects.filter(pk=a.pk).update(data={'a': '1', 'b': '2', 'c': '3'})
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': 'x', 'c': '3'})
+        a.data['d'] = '4'
+        models.Item.objects.filter(pk=a.pk).update(data={'a': 'x', 'c': '3', 'e': '5'})
+        a.full_clean()
+        a.save()
+        self.assertEqual(models.Item.objects.get(pk=a.pk).data, {'a': 'x', 'c': '3', 'd': '4', 'e': '5'})
+
+    def test_inherited_hstore_page(self):
+        b = models.ChildItem.objects.create(name='b', kind='c', data={'a': '2', 'b': '5'})
+        self.assertEqual(hstore_page(models.ChildItem, 'data', b.pk), (2, [('a', '2'), ('b', '5')]))
+        self.assertEqual(hstore_page(models.ChildItem, 'data', b.pk, 1, 1), (2, [('b', '5')]))
+
+    def test_count_many(self):
+        a, b, c = self._create_items(models.Item)
+        models.Related.objects.create(item=a)
+        models.Related.objects.create(item=c)
+        filters = [HQ(data__a__lt=3), HQ(data__g='Dog'), Q(name='a') | Q(name='c'), HQ(data__contains={'a': '1', 'g': 'Apple'}), HQ(), Q(pk__in=[])]
+        with self.assertNumQueries(1):
+            self.assertEqual(count_many(models.Item.objects.all(), filters), [2, 1, 2, 1, 3, 0])
+        self.assertEqual(count_many(models.Item.objects.exclude(name='b'), filters[:2]), [1, 0])
+        filters = [HQ(item__data__a__lt=3), Q(item__name='c'), Q(pk__gt=0)]
+        with self.assertNumQueries(3):
+            self.assertEqual(count_many(models.Related.objects.all(), filters, max_workers=1), [1, 1, 2])
+
+    def test_key_counts(self):
+        self._create_items(models.Item)
+        models.Item.objects.create(name='d', data={'g': 'Dog', 'h': '1'})
+        models.Item.objects.create(name='e', data={'g': 'Dog'})
+        counts = key_counts(models.Item.objects.all(), 'data')
+        self.assertEqual(counts[0], ('g', 5))
+        self.assertEqual(counts[-1], ('h', 1))
+        self.assertEqual(key_counts(models.Item.objects.all(), 'data', limit=2), [('g', 5), ('a', 3)])
+        self.assertEqual(key_counts(models.Item.objects.filter(HQ(data__g='Dog')), 'data', min_count=2), [('g', 3)])
+        self.assertEqual(value_counts(models.Item.objects.all(), 'data', 'g'), [('Dog', 3), ('Apple', 1), ('Car', 1)])
+        self.assertEqual(value_counts(models.Item.objects.exclude(name='e'), 'data', 'g', limit=1, min_count=2), [('Dog', 2)])
+        self.assertEqual(value_counts(models.Item.objects.filter(pk__in=[]), 'data', 'g'), [])
+        self.assertEqual(value_counts(models.Item.objects.none(), 'data', 'g'), [])
+        self.assertEqual(key_counts(models.Item.objects.none(), 'data'), [])
+
+    def test_keyset_page(self):
+        for i in (10, 9, 2, 2, 1):
+            models.Item.objects.create(name=str(i), data={'a': str(i)})
+        models.Item.objects.create(name='x', data={'b': '1'})
+        names, cursor = [], None
+        while True:
+            page, cursor = keyset_page(models.Item.objects.all(), 'data', 'a', int, cursor, size=2)
+            names.append([item.name for item in page])
+            if cursor is None:
+                break
+        self.assertEqual(names, [['1', '2'], ['2', '9'], ['10']])
+        page, cursor = keyset_page(models.Item.objects.all(), 'data', 'a', size=3)
+        self.assertEqual([item.name for item in page], ['1', '10', '2'])
+        page, cursor = keyset_page(models.Item.objects.exclude(name='10'), 'data', 'a', int, size=2, reverse=True)
+        self.assertEqual([item.name for item in page], ['9', '2'])
+        page, cursor = keyset_page(models.Item.objects.all(), 'data', 'a', int, cursor, size=2, reverse=True)
+        self.assertEqual(([item.name for item in page], cursor), (['2', '1'], None))
+        self.assertRaises(ValueError, keyset_page, models.Item.objects.all(), 'data', 'a', int, 'invalid')
+        models.PromotedItem.objects.create(name='a', data={'price': '2.5'})
+        models.PromotedItem.objects.create(name='b', data={'price': '0.5'})
+        page, cursor = keyset_page(models.PromotedItem.objects.all(), 'data', 'price', float, size=1)
+        self.assertEqual(page[0].name, 'b')
+        page, cursor = keyset_page(models.PromotedItem.objects.all(), 'data', 'price', float, cursor, size=1)
+        self.assertEqual(([item.name for item in page], cursor), (['a'], None))
+
+    def test_inherited_keyset_page(self):
+        for i in (3, 1, 2):
+            models.ChildItem.objects.create(name=str(i), kind='c', data={'a': str(i)})
+        page, cursor = keyset_page(models.ChildItem.objects.all(), 'data', 'a', int, size=2)
+        self.assertEqual([item.name for item in page], ['1', '2'])
+        page, cursor = keyset_page(models.ChildItem.objects.all(), 'data', 'a', int, cursor, size=2)
+        self.assertEqual(([item.name for item in page], cursor), (['3'], None))
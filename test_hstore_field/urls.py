@@ -5,6 +5,7 @@ admin.autodiscover()
 
 urlpatterns = patterns('',
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^hstore/', include('hstore_field.urls')),
 )
 
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns